@@ -0,0 +1,133 @@
+import bz2
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+import time
+import zlib
+
+import bz2blocks
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def main(source: str, workers: int = os.cpu_count() or 1, synthetic_mb: int = 0):
+    """Times serial against block-parallel decompression of one tar.bz2 archive.
+
+    Daily everef archives are a few MB, too small to show the parallel reader
+    at its scale; a synthetic archive of several hundred MB can stand in.
+
+    :param source: A local tar.bz2 path, e.g. an everef killmail archive
+    :param workers: Threads used by the parallel reader
+    :param synthetic_mb: Write a synthetic archive of about this many MB to
+        source first, unless one of that size is already there
+    """
+    if synthetic_mb and (
+        not os.path.exists(source)
+        or os.path.getsize(source) < synthetic_mb * 1024 * 1024
+    ):
+        start = time.perf_counter()
+        generate_archive(source, synthetic_mb)
+        print(f"generated {source} in {time.perf_counter() - start:.0f}s")
+
+    print(f"{os.path.getsize(source)} bytes, {os.cpu_count()} CPUs")
+    with open(source, "rb") as file:
+        data = file.read()
+
+    start = time.perf_counter()
+    serial = drain(bz2.BZ2File(io.BytesIO(data)))
+    print(f"  serial: {time.perf_counter() - start:.2f}s, {serial[0]} bytes")
+
+    start = time.perf_counter()
+    with bz2blocks.ParallelBz2Reader(data, workers) as reader:
+        parallel = drain(reader)
+    print(
+        f"parallel: {time.perf_counter() - start:.2f}s, {parallel[0]} bytes, {workers} workers"
+    )
+
+    if serial != parallel:
+        print("MISMATCH between serial and parallel output")
+        sys.exit(1)
+
+    # the archive must still read as a tar when streamed through the reader
+    with bz2blocks.ParallelBz2Reader(data, workers) as reader:
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            members = sum(1 for _ in tar)
+    print(f"{members} tar members")
+
+    print("OK")
+    return
+
+
+def generate_archive(path: str, size_mb: int) -> None:
+    """Writes a tar.bz2 of killmail-shaped JSON documents, like everef's.
+
+    :param path: Where to write the archive
+    :param size_mb: Compressed size to reach, in MB
+    """
+    rng = random.Random(0)  # the same archive on every host
+
+    def participant() -> dict:
+        return {
+            "character_id": rng.randint(90_000_000, 2_120_000_000),
+            "corporation_id": rng.randint(98_000_000, 98_700_000),
+            "alliance_id": rng.randint(99_000_000, 99_013_000),
+            "ship_type_id": rng.choice([587, 594, 608, 11202, 17841, 24690]),
+        }
+
+    with open(path, "wb") as file:
+        with tarfile.open(fileobj=file, mode="w:bz2", compresslevel=9) as tar:
+            killmail_id = 100_000_000
+            while file.tell() < size_mb * 1024 * 1024:
+                killmail_id += 1
+                document = {
+                    "attackers": [
+                        {
+                            **participant(),
+                            "damage_done": rng.randint(0, 20_000),
+                            "final_blow": i == 0,
+                            "security_status": round(rng.uniform(-10, 5), 1),
+                            "weapon_type_id": rng.randint(2_000, 40_000),
+                        }
+                        for i in range(rng.randint(1, 15))
+                    ],
+                    "killmail_id": killmail_id,
+                    "killmail_time": f"2025-09-01T{rng.randint(0, 23):02}:"
+                    f"{rng.randint(0, 59):02}:{rng.randint(0, 59):02}Z",
+                    "solar_system_id": rng.randint(30_000_001, 30_005_000),
+                    "victim": {
+                        **participant(),
+                        "damage_taken": rng.randint(100, 500_000),
+                        "items": [
+                            {
+                                "flag": rng.randint(5, 180),
+                                "item_type_id": rng.randint(1, 60_000),
+                                "quantity_destroyed": rng.randint(1, 100),
+                                "singleton": 0,
+                            }
+                            for _ in range(rng.randint(0, 20))
+                        ],
+                        "position": {axis: rng.uniform(-1e12, 1e12) for axis in "xyz"},
+                    },
+                }
+
+                body = json.dumps(document).encode("utf-8")
+                member = tarfile.TarInfo(f"killmails/{killmail_id}.json")
+                member.size = len(body)
+                tar.addfile(member, io.BytesIO(body))
+    return
+
+
+def drain(file) -> tuple[int, int]:
+    size, checksum = 0, 0
+    while chunk := file.read(CHUNK_SIZE):
+        size += len(chunk)
+        checksum = zlib.crc32(chunk, checksum)
+    return size, checksum
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], *map(int, sys.argv[2:4]))
+    pass
@@ -0,0 +1,84 @@
+import io
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import everef
+import polars as pl
+import writeprofiles
+
+# T1 and faction frigates and interceptors from announce_monthly_hero_tackler
+TACKLER_SHIP_TYPES = [608, 594, 583, 602, 603, 589, 597, 587, 585]
+TACKLER_SHIP_TYPES += [17841, 17619, 17703, 17812, 17928, 17932, 17924, 33816, 17930]
+TACKLER_SHIP_TYPES += [11202, 11200, 11196, 11198, 11176, 11178, 11184, 11186]
+
+SCAN_REPEATS = 5  # best of, to leave out the page cache warming up
+
+
+def main(sources: list[str]):
+    """Writes the same killmails with every write profile and reports file size,
+    write time and the time of a hero tackler query over the file.
+
+    :param sources: Dates (YYYY-MM-DD) to download from everef, or local tar.bz2 paths
+    """
+    killmails = pl.concat(
+        [everef.Killmail.read_killmails(load(source)).collect() for source in sources]
+    )
+    print(f"{killmails.height} rows from {len(sources)} archives")
+
+    # one month, like the monthly announcement
+    start_date = killmails["date"].min().replace(day=1)
+    end_date = (start_date + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in writeprofiles.WRITE_PROFILES:
+            path = os.path.join(directory, f"{profile}.parquet")
+
+            start = time.perf_counter()
+            writeprofiles.write(
+                writeprofiles.prepare(killmails, profile), path, profile
+            )
+            write_time = time.perf_counter() - start
+
+            scan_times = []
+            for _ in range(SCAN_REPEATS):
+                start = time.perf_counter()
+                hero_tackler(pl.scan_parquet(path), start_date, end_date)
+                scan_times.append(time.perf_counter() - start)
+
+            print(
+                f"{profile:>16}: {os.path.getsize(path) / 1024:>10.1f} KiB, "
+                f"write {write_time:.3f}s, hero tackler {min(scan_times):.4f}s"
+            )
+
+    return
+
+
+def load(source: str) -> io.BytesIO:
+    if source.endswith(".tar.bz2"):
+        with open(source, "rb") as file:
+            return io.BytesIO(file.read())
+
+    date = datetime.strptime(source, "%Y-%m-%d").date()
+    return io.BytesIO(everef.Killmail.download_killmails_archive(date))
+
+
+def hero_tackler(killmails: pl.LazyFrame, start_date, end_date) -> pl.DataFrame:
+    return (
+        killmails.filter(
+            (pl.col("date") >= start_date) & (pl.col("date") <= end_date),
+            (pl.col("is_loss") == False),
+            (pl.col("victim_character_id").is_not_null()),
+            pl.col("attacker_ship_type_id").is_in(TACKLER_SHIP_TYPES),
+        )
+        .group_by(["attacker_character_id", "attacker_ship_type_id"])
+        .agg(pl.n_unique("killmail_id").alias("kill_count"))
+        .collect()
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+    pass
@@ -0,0 +1,43 @@
+import io
+import sys
+import time
+from datetime import datetime
+
+import everef
+
+SORT_KEYS = ["killmail_id", "attacker_character_id", "attacker_damage_done"]
+
+
+def main(source: str):
+    """Decodes one everef archive with every engine and checks the results match.
+
+    :param source: A date (YYYY-MM-DD) to download from everef, or a local tar.bz2 path
+    """
+    if source.endswith(".tar.bz2"):
+        with open(source, "rb") as file:
+            archive = file.read()
+    else:
+        date = datetime.strptime(source, "%Y-%m-%d").date()
+        archive = everef.Killmail.download_killmails_archive(date)
+
+    results = {}
+    for engine in ["rows", "columnar"]:
+        start = time.perf_counter()
+        killmails = everef.Killmail.read_killmails(io.BytesIO(archive), engine)
+        results[engine] = killmails.collect().sort(SORT_KEYS)
+
+        print(
+            f"{engine:>10}: {time.perf_counter() - start:.2f}s, {results[engine].height} rows"
+        )
+
+    if not results["rows"].equals(results["columnar"]):
+        print("MISMATCH between rows and columnar engines")
+        sys.exit(1)
+
+    print("OK")
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
+    pass
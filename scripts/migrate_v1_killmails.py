@@ -0,0 +1,77 @@
+import json
+from datetime import datetime
+
+import datalake
+import everef
+import polars as pl
+
+# what the single-tenant ingest wrote before killmails were partitioned by tenant
+V1_TOTALS_KEY = "killmail-totals.json"
+V1_PREFIX = "killmails/date="
+
+
+def main():
+    """Moves the killmails of the v1 layout (killmails/date=*) into the FORCA
+    tenant of the live dataset, then deletes them.
+
+    The v1 files only hold FORCA killmails, with the same columns as a version 1
+    row minus the tenant. Each date is committed to the ledger with its v1 total,
+    so the ingest does not download it again, and is left rollup_pending, so the
+    next run rebuilds its rollups. Run it once before the first tenant-layout
+    ingest; interrupted runs can be restarted.
+    """
+    stored = datalake.backend.get(V1_TOTALS_KEY)
+    totals = json.loads(stored[0]) if stored else {}
+
+    # dates the ledger already has were ingested into the tenant layout
+    entries = datalake.IngestLedger.get(version=1)
+    dates = datalake.IngestLedger.claim(
+        {
+            date: count
+            for date, count in sorted(totals.items())
+            if count > 0 and "source_count" not in entries.get(date, {})
+        },
+        "migrate-v1",
+        version=1,
+    )
+    print(f"Migrating {len(dates)} dates to tenant={datalake.DEFAULT_TENANT}")
+
+    for i, date in enumerate(dates, start=1):
+        day = datetime.strptime(date, "%Y%m%d").date()
+        keys = datalake.backend.list(f"{V1_PREFIX}{day}/")
+
+        # a date without a FORCA killmail has no v1 file
+        written = {"rows_written": 0, "files": []}
+        if keys:
+            killmails = pl.concat(
+                [
+                    pl.scan_parquet(datalake.backend.url(key), hive_partitioning=False)
+                    for key in keys
+                ]
+            ).with_columns(
+                pl.lit(datalake.DEFAULT_TENANT).alias("tenant"),
+                pl.lit(day).alias("date"),
+            )
+            written = datalake.Killmail.upsert(
+                killmails.select(everef.KILLMAIL_SCHEMA.names()).cast(
+                    everef.KILLMAIL_SCHEMA
+                ),
+                version=1,
+            )
+
+        # the archive was never hashed
+        datalake.IngestLedger.commit(date, totals[date], written, "", version=1)
+        print(f"[{i}/{len(dates)}] {date} {written['rows_written']} rows")
+
+    # every v1 date is now in the ledger, its files are not read by anything
+    for key in datalake.backend.list(V1_PREFIX):
+        datalake.backend.delete(key)
+    datalake.backend.delete(V1_TOTALS_KEY)
+
+    print("OK")
+    return
+
+
+if __name__ == "__main__":
+    main()
+    pass
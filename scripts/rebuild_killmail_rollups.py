@@ -0,0 +1,40 @@
+import sys
+from datetime import datetime
+
+import datalake
+import everef
+
+
+def main(since: str | None = None):
+    """Recomputes the leaderboard rollups and the activity index of the live
+    dataset from its killmail rows.
+
+    Ingest keeps the rollups up to date for the dates it touches, this fills
+    them in for dates ingested before they existed.
+
+    :param since: First date to rebuild (YYYY-MM-DD), every ingested date if None
+    """
+    dates = sorted(
+        datetime.strptime(date, "%Y%m%d").date()
+        for date, entry in datalake.IngestLedger.get().items()
+        if entry.get("source_count", 0) > 0
+    )
+    if since:
+        dates = [
+            date
+            for date in dates
+            if date >= datetime.strptime(since, "%Y-%m-%d").date()
+        ]
+
+    for tenant in everef.TRACKED_ENTITIES:
+        print(f"Rebuilding {len(dates)} dates of {tenant}")
+        datalake.KillmailRollup.update(tenant, dates)
+        datalake.ActivityIndex.update(tenant, dates)
+
+    print("OK")
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
+    pass
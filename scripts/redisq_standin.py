@@ -0,0 +1,52 @@
+import io
+import json
+import sys
+import tarfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def load_killmails(path: str) -> list[dict]:
+    with open(path, "rb") as file:
+        archive = file.read()
+
+    killmails = []
+    with tarfile.open(fileobj=io.BytesIO(archive), mode="r:bz2") as tar:
+        for member in tar:
+            file = tar.extractfile(member)
+            if file:
+                killmails.append(json.loads(file.read()))
+
+    return sorted(killmails, key=lambda killmail: killmail["killmail_time"])
+
+
+class RedisQStandIn(BaseHTTPRequestHandler):
+    """Replays an everef archive as a RedisQ feed, one killmail per request."""
+
+    killmails: list[dict] = []
+
+    def do_GET(self):
+        if self.killmails:
+            killmail = self.killmails.pop(0)
+            package = {"killID": killmail["killmail_id"], "killmail": killmail}
+        else:
+            package = None
+
+        body = json.dumps({"package": package}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+
+def main(path: str, port: int):
+    RedisQStandIn.killmails = load_killmails(path)
+    print(f"Serving {len(RedisQStandIn.killmails)} killmails on port {port}")
+    HTTPServer(("localhost", port), RedisQStandIn).serve_forever()
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8080)
+    pass
@@ -0,0 +1,84 @@
+import hashlib
+import io
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import datalake
+import everef
+
+
+def main(workers: int):
+    """Rebuilds every ingested date for everef.KILLMAIL_SCHEMA_VERSION, then makes
+    it the version readers see.
+
+    Archives come from everef.HttpCache without revalidation, so with a warm
+    EVEREF_CACHE_URL nothing is downloaded again. The new version is written next
+    to the live one, which keeps serving reads until the pointer is switched.
+
+    :param workers: Number of processes decoding archives in parallel
+    """
+    version = everef.KILLMAIL_SCHEMA_VERSION
+    if datalake.Killmail.get_version() == version:
+        print(f"Dataset is already at version {version}")
+        return
+
+    # the new version's ledger is filled as dates are written, so a run that
+    # was interrupted only redoes the dates it had not committed
+    totals = {
+        date: entry["source_count"]
+        for date, entry in sorted(datalake.IngestLedger.get().items())
+        if entry.get("source_count", 0) > 0
+    }
+    done = datalake.IngestLedger.get(version=version)
+    dates = [
+        date
+        for date, count in totals.items()
+        if done.get(date, {}).get("source_count") != count
+    ]
+    print(f"Reprocessing {len(dates)} dates into version {version}")
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        counts = [totals[date] for date in dates]
+        for i, date in enumerate(executor.map(reprocess_date, dates, counts), start=1):
+            print(f"[{i}/{len(dates)}] {date}")
+
+    # leaderboards and the activity index of the new version must be ready
+    # when readers switch to it; the dates committed above are rebuilt here
+    # rather than left pending for the ingest
+    pending = datalake.IngestLedger.claim_rollups("reprocess", version=version)
+    ingested = [datetime.strptime(date, "%Y%m%d").date() for date in totals]
+    for tenant in everef.TRACKED_ENTITIES:
+        datalake.KillmailRollup.update(tenant, ingested, version=version)
+        datalake.ActivityIndex.update(tenant, ingested, version=version)
+    datalake.IngestLedger.release_rollups("reprocess", pending, version=version)
+
+    datalake.Killmail.set_version(version)
+    print(f"Readers switched to version {version}")
+    return
+
+
+def reprocess_date(date: str, source_count: int) -> str:
+    archive = everef.Killmail.download_killmails_archive(
+        datetime.strptime(date, "%Y%m%d").date(), revalidate=False
+    )
+    killmails = everef.Killmail.read_killmails(io.BytesIO(archive))
+    written = datalake.Killmail.upsert(
+        killmails, version=everef.KILLMAIL_SCHEMA_VERSION
+    )
+    datalake.IngestLedger.commit(
+        date,
+        source_count,
+        written,
+        hashlib.sha256(archive).hexdigest(),
+        version=everef.KILLMAIL_SCHEMA_VERSION,
+    )
+    return date
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count())
+    pass
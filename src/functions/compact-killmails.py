@@ -0,0 +1,34 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import datalake
+import everef
+
+# a month is compacted once its last day is this old, when everef archives
+# have mostly stopped changing; later changes are merged into the month file
+COMPACTION_DELAY_DAYS = 7
+
+
+def handler(event, context):
+
+    closed_before = (
+        datetime.now(timezone.utc).date() - timedelta(days=COMPACTION_DELAY_DAYS)
+    ).replace(day=1)
+
+    compacted = []
+    for tenant in everef.TRACKED_ENTITIES:
+        for month in datalake.Killmail.get_uncompacted_months(
+            tenant, version=everef.KILLMAIL_SCHEMA_VERSION
+        ):
+            if month >= closed_before.strftime("%Y-%m"):
+                continue
+
+            if datalake.Killmail.compact(
+                tenant, month, version=everef.KILLMAIL_SCHEMA_VERSION
+            ):
+                compacted.append(f"{tenant}/{month}")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps(f"Compacted {', '.join(compacted) or 'nothing'}"),
+    }
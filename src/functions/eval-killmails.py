@@ -1,14 +1,52 @@
+import hashlib
+import io
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
+import boto3
 import datalake
 import db
 import discord
 import eveonline
 import everef
+import pipeline
 import polars as pl
 from requests import HTTPError
 
+# "pipeline" ingests as many dates as the invocation's time budget allows,
+# "fanout" splits every changed date into work items for parallel workers
+INGEST_MODE = os.environ.get("INGEST_MODE", "pipeline")
+INGEST_QUEUE_URL = os.environ.get("INGESTKILLMAILS_QUEUE_URL", "")
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "4"))  # local queue only
+SQS_SEND_ATTEMPTS = 3  # per work item, before its date is given back
+
+# also store every killmail in full (killmails, attackers, items) while decoding
+KEEP_RAW_KILLMAILS = os.environ.get("KEEP_RAW_KILLMAILS", "false") == "true"
+
+sqs = boto3.client("sqs")
+
+# decoded archives wait here, as local Parquet, until they are written to S3
+DECODED_DIR = os.path.join(
+    os.environ.get("POLARS_TEMP_DIR", tempfile.gettempdir()), "decoded-killmails"
+)
+
+# an archive in flight holds its compressed bytes plus one decoded batch and the
+# open parquet row groups while it is streamed into the datalake
+ARCHIVE_MEMORY_FACTOR = 2
+
+# scheduling of dates within a single invocation
+RECENT_DAYS = 7  # dates this recent are ingested first, newest first
+DEADLINE_MARGIN_MS = 30_000  # kept free for the announcement and final commits
+DEFAULT_SECONDS_PER_KILLMAIL = 0.002  # cost estimate until a run has been measured
+COST_SMOOTHING = 0.3  # weight of the latest run in the cost estimate
+
 MES = {
     1: "JANEIRO",
     2: "FEVEREIRO",
@@ -27,7 +65,16 @@ MES = {
 
 def handler(event, context):
 
-    update_killmails()
+    if "Records" in event:  # fanned-out work items from SQS
+        for record in event["Records"]:
+            ingest_work_item(json.loads(record["body"]))
+
+        return {
+            "statusCode": 200,
+            "body": json.dumps("Killmails Ingested!"),
+        }
+
+    update_killmails(context)
 
     if datetime.now(timezone.utc).date().day == 3:
         announce_monthly_hero_tackler()
@@ -38,30 +85,330 @@ def handler(event, context):
     }
 
 
-def update_killmails():
+def update_killmails(context=None):
+
+    version = everef.KILLMAIL_SCHEMA_VERSION
+
+    # warm containers keep the files a failed run had decoded but not written
+    shutil.rmtree(DECODED_DIR, ignore_errors=True)
+
+    # dates a failed run committed without getting to their rollups
+    owner = uuid.uuid4().hex
+    drain_rollups(owner)
 
     remote_totals = everef.Killmail.fetch_totals()
-    local_totals = datalake.Killmail.get_totals()
-
-    dates_to_fetch = sorted(
-        [
-            datetime.strptime(date, "%Y%m%d").date()
-            for date in remote_totals.keys()
-            if remote_totals.get(date) > 0
-            and remote_totals.get(date) != local_totals.get(date)
-        ]
-    )[-15:]
+    local_totals = datalake.IngestLedger.diff(remote_totals, version=version)
 
-    if dates_to_fetch:
+    if INGEST_MODE == "fanout":
+        if local_totals:
+            fan_out_killmails(sorted(local_totals), remote_totals)
+        return
+
+    # another run may be ingesting some of the same dates, each one takes
+    # only the dates it managed to claim
+    dates_to_fetch = datalake.IngestLedger.claim(
+        {
+            date: remote_totals[date]
+            for date in schedule_dates(remote_totals, local_totals)
+        },
+        owner,
+        version=version,
+    )
+    if not dates_to_fetch:
+        return
+
+    stats = datalake.Killmail.get_ingest_stats()
+    seconds_per_killmail = stats.get(
+        "seconds_per_killmail", DEFAULT_SECONDS_PER_KILLMAIL
+    )
+
+    # estimated seconds of dates handed to the pipeline but not committed yet
+    in_flight = {}
+    in_flight_lock = threading.Lock()
+
+    def admitted_dates():
         for date in dates_to_fetch:
-            killmail_data = everef.Killmail.fetch_killmails_from_date(date)
-            datalake.Killmail.upsert(killmail_data)
+            cost = remote_totals[date] * seconds_per_killmail
+
+            with in_flight_lock:
+                needed_ms = (sum(in_flight.values()) + cost) * 1000
+                if context and needed_ms > (
+                    context.get_remaining_time_in_millis() - DEADLINE_MARGIN_MS
+                ):
+                    print(f"Not enough time left for {date}, leaving it for next run")
+                    continue
+                in_flight[date] = cost
+
+            yield datetime.strptime(date, "%Y%m%d").date()
+
+    ingest = pipeline.Pipeline(
+        stages=[
+            everef.Killmail.download_killmails_archive,
+            decode_archive,
+            commit_killmails,
+        ],
+        reserve=lambda archive: len(archive) * ARCHIVE_MEMORY_FACTOR,
+    )
+
+    start = time.monotonic()
+    committed = []
+
+    try:
+        for date, (written, content_hash) in ingest.run(admitted_dates()):
+            date = date.strftime("%Y%m%d")
+
+            # commit per date so a run cut short keeps what it already wrote
+            datalake.IngestLedger.commit(
+                date, remote_totals[date], written, content_hash, version=version
+            )
+
+            with in_flight_lock:
+                in_flight.pop(date)
+            committed.append(date)
+    finally:
+        datalake.IngestLedger.release(
+            [date for date in dates_to_fetch if date not in committed],
+            owner,
+            version=version,
+        )
 
-        datalake.Killmail.set_totals(remote_totals)
+    drain_rollups(owner)
+
+    killmail_count = sum(remote_totals[date] for date in committed)
+    if killmail_count:
+        measured = (time.monotonic() - start) / killmail_count
+        datalake.Killmail.set_ingest_stats(
+            {
+                **stats,
+                "seconds_per_killmail": COST_SMOOTHING * measured
+                + (1 - COST_SMOOTHING) * seconds_per_killmail,
+            }
+        )
 
     return
 
 
+def schedule_dates(remote_totals: dict, local_totals: dict) -> list[str]:
+    """Orders the dates whose everef count changed by ingest priority.
+
+    Recent dates come first, newest first, since they are the ones still being
+    filled in. Older dates follow, largest count change first.
+
+    :param remote_totals: everef's killmail count per date, keyed YYYYMMDD
+    :param local_totals: The ingested count of each date to fetch, as returned
+        by datalake.IngestLedger.diff
+    :returns: Date keys to ingest, highest priority first
+    """
+    changed = list(local_totals)
+
+    recent_cutoff = (
+        datetime.now(timezone.utc).date() - timedelta(days=RECENT_DAYS)
+    ).strftime("%Y%m%d")
+
+    recent = sorted([date for date in changed if date >= recent_cutoff], reverse=True)
+    older = sorted(
+        [date for date in changed if date < recent_cutoff],
+        key=lambda date: abs(remote_totals[date] - local_totals.get(date, 0)),
+        reverse=True,
+    )
+
+    return recent + older
+
+
+def fan_out_killmails(dates_to_fetch: list[str], remote_totals: dict):
+
+    if datalake.IngestJob.get_open():
+        print("Previous ingest job is still running, skipping")
+        return
+
+    job_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    dates_to_fetch = datalake.IngestLedger.claim(
+        {date: remote_totals[date] for date in dates_to_fetch},
+        job_id,
+        ttl=datalake.INGEST_JOB_TTL,
+        version=everef.KILLMAIL_SCHEMA_VERSION,
+    )
+    if not dates_to_fetch:
+        return
+
+    work_items = [
+        {
+            "job_id": job_id,
+            "date": datetime.strptime(date, "%Y%m%d").date().isoformat(),
+            "source_count": remote_totals[date],
+        }
+        for date in dates_to_fetch
+    ]
+
+    datalake.IngestJob.create(job_id, [item["date"] for item in work_items])
+
+    # local stand-in for the queue, the executor hands out work items
+    if not INGEST_QUEUE_URL:
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            list(executor.map(ingest_work_item, work_items))
+        return
+
+    unsent = []
+    for i in range(0, len(work_items), 10):  # SQS batch limit
+        unsent.extend(send_work_items(work_items[i : i + 10]))
+
+    if unsent:
+        # no worker will ever see these dates: the next run claims them again,
+        # and the job is finished without them
+        datalake.IngestLedger.release(
+            [item["date"].replace("-", "") for item in unsent],
+            job_id,
+            version=everef.KILLMAIL_SCHEMA_VERSION,
+        )
+        for item in unsent:
+            if datalake.IngestJob.complete(job_id, item["date"]):
+                drain_rollups(f"{job_id}/{uuid.uuid4().hex}")
+
+        raise RuntimeError(
+            f"Could not queue {len(unsent)} work items: "
+            + ", ".join(item["date"] for item in unsent)
+        )
+
+    return
+
+
+# send_message_batch succeeds as a call even when some of its entries fail
+def send_work_items(work_items: list[dict]) -> list[dict]:
+    """Queues work items, retrying the entries SQS did not accept.
+
+    :param work_items: At most 10 work items
+    :returns: The work items still not queued after SQS_SEND_ATTEMPTS
+    """
+    pending = dict(enumerate(work_items))
+
+    for attempt in range(SQS_SEND_ATTEMPTS):
+        if attempt:
+            time.sleep(2**attempt)
+
+        response = sqs.send_message_batch(
+            QueueUrl=INGEST_QUEUE_URL,
+            Entries=[
+                {"Id": str(j), "MessageBody": json.dumps(item)}
+                for j, item in pending.items()
+            ],
+        )
+        for failure in response.get("Failed", []):
+            print(f"Queueing work item failed: {failure}")
+        pending = {
+            int(failure["Id"]): pending[int(failure["Id"])]
+            for failure in response.get("Failed", [])
+        }
+        if not pending:
+            break
+
+    return list(pending.values())
+
+
+def ingest_work_item(work_item: dict):
+
+    date = datetime.fromisoformat(work_item["date"]).date()
+
+    # the job owns the date claims, but the rollup lease has to tell its
+    # workers apart
+    lease_owner = f"{work_item['job_id']}/{uuid.uuid4().hex}"
+
+    # dates of workers that failed after committing
+    drain_rollups(lease_owner)
+
+    archive = everef.Killmail.download_killmails_archive(date)
+    written, content_hash = commit_killmails(decode_archive(archive))
+    datalake.IngestLedger.commit(
+        date.strftime("%Y%m%d"),
+        work_item["source_count"],
+        written,
+        content_hash,
+        version=everef.KILLMAIL_SCHEMA_VERSION,
+    )
+
+    job = datalake.IngestJob.complete(work_item["job_id"], work_item["date"])
+    if job:  # last date of the job, everything has been committed
+        drain_rollups(lease_owner)
+
+    return
+
+
+# rebuilds the rollups and the activity index of every committed date that
+# is still behind; skipped while another ingester holds the rollup lease
+def drain_rollups(owner: str):
+
+    version = everef.KILLMAIL_SCHEMA_VERSION
+    pending = datalake.IngestLedger.claim_rollups(owner, version=version)
+
+    rebuilt = {}
+    try:
+        update_rollups([datetime.strptime(date, "%Y%m%d").date() for date in pending])
+        rebuilt = pending
+    finally:
+        datalake.IngestLedger.release_rollups(owner, rebuilt, version=version)
+
+    return
+
+
+def update_rollups(dates: list):
+
+    if not dates:
+        return
+
+    for tenant in everef.TRACKED_ENTITIES:
+        datalake.KillmailRollup.update(
+            tenant, dates, version=everef.KILLMAIL_SCHEMA_VERSION
+        )
+        datalake.ActivityIndex.update(
+            tenant, dates, version=everef.KILLMAIL_SCHEMA_VERSION
+        )
+
+    return
+
+
+# decodes on its own pipeline stage: the rows are streamed into a local file,
+# so the next archive is decoded while this one is written to S3
+def decode_archive(archive: bytes) -> tuple:
+
+    # recorded in the ledger, tells a re-published archive from a changed one
+    content_hash = hashlib.sha256(archive).hexdigest()
+
+    raw_tables = None
+    if KEEP_RAW_KILLMAILS:
+        killmails, raw_tables = everef.Killmail.read_killmails_with_raw(
+            io.BytesIO(archive)
+        )
+    else:
+        killmails = everef.Killmail.read_killmails(io.BytesIO(archive))
+
+    if killmails is None:
+        return None, raw_tables, content_hash
+
+    os.makedirs(DECODED_DIR, exist_ok=True)
+    decoded = os.path.join(DECODED_DIR, f"{uuid.uuid4().hex}.parquet")
+    killmails.sink_parquet(decoded, compression="lz4")
+
+    return decoded, raw_tables, content_hash
+
+
+def commit_killmails(decoded: tuple) -> tuple[dict, str]:
+
+    path, raw_tables, content_hash = decoded
+
+    try:
+        written = datalake.Killmail.upsert(
+            pl.scan_parquet(path) if path else None,
+            version=everef.KILLMAIL_SCHEMA_VERSION,
+        )
+    finally:
+        if path:
+            os.remove(path)
+
+    if raw_tables:
+        datalake.RawKillmail.upsert(raw_tables)
+
+    return written, content_hash
+
+
 def announce_monthly_hero_tackler():
 
     # CHANNEL_ID = 1346269756256288963  # dev
@@ -116,31 +463,32 @@ def announce_monthly_hero_tackler():
     end_date = datetime.now().date().replace(day=1) - timedelta(days=1)
     start_date = end_date.replace(day=1)
 
-    killmails = datalake.Killmail.get().filter(
-        (pl.col("date") >= start_date) & (pl.col("date") <= end_date),
+    # kills of characters, counted per character and ship by the ingest rollups
+    kills = datalake.KillmailRollup.get(start=start_date, end=end_date).filter(
         (pl.col("is_loss") == False),
-        (pl.col("victim_character_id").is_not_null()),
+        (pl.col("character_victim_count") > 0),
     )
 
     hero_tackler = (
-        killmails.filter(
-            pl.col("attacker_ship_type_id").is_in(TACKLER_SHIP_TYPES),
+        kills.filter(
+            pl.col("ship_type_id").is_in(TACKLER_SHIP_TYPES),
         )
-        .group_by(["attacker_character_id", "attacker_ship_type_id"])
+        .group_by(["character_id", "ship_type_id"])
         .agg(
             [
-                pl.n_unique("killmail_id").alias("kill_count"),
+                pl.sum("character_victim_count").alias("kill_count"),
             ]
         )
         .sort("kill_count", descending=True)
-        .group_by("attacker_character_id")
+        .group_by("character_id")
         .agg(
             [
                 pl.sum("kill_count").alias("total_kill_count"),
-                pl.first("attacker_ship_type_id").alias("main_ship_type_id"),
+                pl.first("ship_type_id").alias("main_ship_type_id"),
                 pl.first("kill_count").alias("main_ship_kill_count"),
             ]
         )
+        .rename({"character_id": "attacker_character_id"})
         .sort("total_kill_count", descending=True)
     ).collect()
 
@@ -0,0 +1,50 @@
+import json
+import os
+import time
+
+import datalake
+import everef
+import zkillboard
+
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "100"))  # killmails
+STREAM_BATCH_SECONDS = int(os.environ.get("STREAM_BATCH_SECONDS", "60"))
+LISTEN_SECONDS = 10
+DEADLINE_MARGIN_MS = 30_000  # one listen plus a final commit
+
+
+def handler(event, context):
+
+    buffer = []
+    batch_started = time.monotonic()
+    committed = 0
+
+    while context.get_remaining_time_in_millis() > DEADLINE_MARGIN_MS:
+        killmail = zkillboard.RedisQ.listen(LISTEN_SECONDS)
+        if killmail:
+            buffer.append(killmail)
+
+        if len(buffer) >= STREAM_BATCH_SIZE or (
+            buffer and time.monotonic() - batch_started >= STREAM_BATCH_SECONDS
+        ):
+            committed += commit_batch(buffer)
+            buffer.clear()
+            batch_started = time.monotonic()
+
+    if buffer:
+        committed += commit_batch(buffer)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps(f"{committed} killmail rows streamed"),
+    }
+
+
+def commit_batch(killmails: list[dict]) -> int:
+
+    rows = everef.Killmail.unpack_killmails(killmails)
+    if rows.height:
+        datalake.Killmail.append_stream_batch(
+            rows, version=everef.KILLMAIL_SCHEMA_VERSION
+        )
+
+    return rows.height
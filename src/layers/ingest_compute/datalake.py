@@ -1,46 +1,1866 @@
+import hashlib
+import io
 import json
+import math
 import os
+from datetime import date, datetime, timedelta, timezone
 
-import boto3
+import everef
+import hotcache
 import polars as pl
+import storage
+import writeprofiles
 
-s3_client = boto3.client("s3")
+# where the datalake lives: "s3://bucket/prefix", or a local directory to run
+# and profile ingest and queries without AWS; the Lambda bucket by default
+DATALAKE_URL = os.environ.get("DATALAKE_URL") or (
+    f"s3://{os.environ['DATALAKE_BUCKET_NAME']}"
+)
+backend = storage.connect(DATALAKE_URL)
 
-DATALAKE_BUCKET = os.environ["DATALAKE_BUCKET_NAME"]
+DEFAULT_TENANT = "FORCA"
+
+# v2: killmails are partitioned by tenant then date. The v1 layout
+# (killmails/date=*) is not read; scripts/migrate_v1_killmails.py moves it into
+# tenant=FORCA and deletes it, otherwise the ingest downloads it all again.
+# Superseded by IngestLedger, only read to seed it.
+TOTALS_KEY = "killmail-totals-v2.json"
+
+# readers follow this pointer to the dataset version they should scan, so a
+# reprocessed version can be built next to the live one and swapped in at once
+DATASET_POINTER_KEY = "killmail-dataset.json"
+
+# name of the file each partition gets when killmails are staged by upsert
+PARTITION_FILE = "0.parquet"
+
+# per-tenant manifests and per-partition killmail id lists
+INDEX_PREFIX = "indexes"
+
+# per-file statistics kept in the manifest, used to skip files when planning
+MANIFEST_STAT_COLUMNS = [
+    "date",
+    "killmail_id",
+    "solar_system_id",
+    "victim_character_id",
+    "victim_corporation_id",
+    "victim_alliance_id",
+    "victim_ship_type_id",
+    "attacker_character_id",
+    "attacker_corporation_id",
+    "attacker_alliance_id",
+    "attacker_ship_type_id",
+]
+
+# "normalized" writes each data file as a one-row-per-killmail table plus a
+# participation table of its attackers, joined back on read, so fights with
+# many attackers do not repeat the victim columns on every row
+STORAGE_MODE = os.environ.get("KILLMAIL_STORAGE_MODE", "denormalized")
+PARTICIPATION_COLUMNS = [
+    "killmail_id",
+    "attacker_character_id",
+    "attacker_corporation_id",
+    "attacker_alliance_id",
+    "attacker_ship_type_id",
+    "attacker_weapon_type_id",
+    "attacker_damage_done",
+]
+
+# leaderboard rollups, keyed by date (daily) or month (monthly) then these
+ROLLUP_KEYS = ["date", "character_id", "ship_type_id", "is_loss"]
+ROLLUP_MEASURES = ["killmail_count", "character_victim_count"]
+ROLLUP_SCHEMA = {
+    "character_id": pl.UInt32,
+    "ship_type_id": pl.UInt32,
+    "is_loss": pl.Boolean,
+    "killmail_count": pl.UInt32,
+    "character_victim_count": pl.UInt32,
+}
+
+# optional HyperLogLog sketches of the killmail ids of each rollup row, so
+# distinct killmails over any group of characters and ships and any window can
+# be estimated from rollups, where summing counts would count a killmail once
+# per member involved. Registers are kept sparse, as register * 64 + rank.
+ROLLUP_SKETCHES = os.environ.get("ROLLUP_SKETCHES", "false") == "true"
+SKETCH_PRECISION = 12  # 4096 registers, 1.6% standard error
+
+# bit n of a character's activity bitmap is set if they appeared, as attacker or
+# victim, on the n-th day after this one (EVE's launch)
+ACTIVITY_EPOCH = date(2003, 5, 6)
+
+INGEST_JOB_TTL = timedelta(hours=6)  # open jobs older than this are abandoned
+INGEST_CLAIM_TTL = timedelta(minutes=30)  # dates claimed longer ago are free again
+
+
+class ManifestConflict(Exception):
+    """The files a merge was computed from were replaced before it was published."""
 
 
 class Killmail:
 
     @staticmethod
-    def upsert(killmails: pl.LazyFrame) -> None:
+    def upsert(killmails: pl.LazyFrame, version: int | None = None) -> dict:
+        """Writes killmail rows into their tenant/date partitions.
+
+        Rows replace the ones already stored for the same killmail, and the
+        killmails the new rows do not cover are kept, so re-ingesting a date any
+        number of times leaves one copy of each (killmail_id,
+        attacker_character_id) row.
+
+        :param killmails: KILLMAIL_SCHEMA rows
+        :param version: Dataset version the rows belong to, the live one if None
+        :returns: The number of rows written and the data files now holding them
+        """
+        written = {"rows_written": 0, "files": []}
         if killmails is None:
+            return written
+
+        prefix = Killmail._dataset_prefix(version)
+        staging = f"staging/{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}"
+
+        # streamed into one open file per partition, row group by row group, so
+        # a lazily decoded day never has to be materialized as a whole
+        staged = []
+        killmails.sink_parquet(
+            pl.PartitionByKey(
+                backend.url(staging),
+                by=["tenant", "date"],
+                finish_callback=staged.append,
+            ),
+            mkdir=True,
+        )
+
+        partitions = {
+            (keys["tenant"], keys["date"])
+            for files in staged
+            for keys in files["keys"].to_list()
+        }
+        for tenant, date in sorted(partitions):
+            key, rows = Killmail._until_published(
+                prefix,
+                tenant,
+                (str(date)[:7], date),
+                Killmail._replace_partition,
+                prefix,
+                staging,
+                tenant,
+                date,
+            )
+            written["rows_written"] += rows
+            written["files"].append(key)
+
+        for key in backend.list(f"{staging}/"):
+            backend.delete(key)
+        return written
+
+    # a merge that lost against another writer of its partition is computed
+    # again, from the files that writer published. The same goes for a merge
+    # whose input was swapped out and deleted while it read it, which polars
+    # reports as an OSError; one with the partition unchanged is a real error.
+    @staticmethod
+    def _until_published(dataset: str, tenant: str, scope: tuple, merge, *args):
+        while True:
+            manifest, _ = Killmail._get_manifest(dataset, tenant)
+            base = Killmail._partition_keys(manifest, dataset, tenant, *scope)
+            try:
+                return merge(*args)
+            except ManifestConflict:
+                pass
+            except OSError:
+                manifest, _ = Killmail._get_manifest(dataset, tenant)
+                if Killmail._partition_keys(manifest, dataset, tenant, *scope) == base:
+                    raise
+
+    # writes the merged rows of a partition as a new file and swaps it in for
+    # the files it supersedes with one manifest update; returns that file and
+    # the number of staged rows
+    @staticmethod
+    def _replace_partition(
+        dataset: str, staging: str, tenant: str, date
+    ) -> tuple[str, int]:
+        prefix = f"{dataset}/tenant={tenant}/date={date}/"
+        month = str(date)[:7]
+
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        base = Killmail._partition_keys(manifest, dataset, tenant, month, date)
+        month_key = Killmail._month_file(manifest, month)
+        keys = [key for key in base if key != month_key]
+
+        # the merge stays lazy and is streamed into the new file, only the
+        # killmail ids of the day are held in memory
+        staged_key = f"{staging}/tenant={tenant}/date={date}/{PARTITION_FILE}"
+        staged = pl.scan_parquet(backend.url(staged_key), hive_partitioning=False)
+        staged_column = staged.select("killmail_id").collect()["killmail_id"]
+        existing_ids = Killmail._get_index(dataset, tenant, date, manifest)
+        staged_ids = set(staged_column)
+        retained_ids = existing_ids - staged_ids
+
+        # a compacted month holds the day in its month file, which is rewritten
+        if month_key:
+            kept = pl.concat(
+                [Killmail._scan_file(key, manifest["files"][key]) for key in base]
+            ).filter(~pl.col("killmail_id").is_in(staged_ids))
+            merged = pl.concat([staged, kept])
+            month_ids = merged.group_by("date").agg("killmail_id").collect()
+            key = Killmail._write_month(
+                dataset,
+                tenant,
+                month,
+                merged,
+                replaces=base,
+                scope=(month, date),
+                base=base,
+            )
+
+            # the other days of the month now live in the new file as well;
+            # days that also have stream files keep their index until read
+            days_with_files = {
+                key.split("/date=", 1)[1][:10]
+                for key in manifest["files"]
+                if "/date=" in key
+            }
+            for day, ids in month_ids.iter_rows():
+                if str(day) == str(date) or str(day) not in days_with_files:
+                    Killmail._put_index(dataset, tenant, day, set(ids), [key])
+            return key, len(staged_column)
+
+        # killmails the new rows do not cover are the only ones read back
+        rows = len(staged_column)
+        if retained_ids:
+            retained = pl.concat(
+                [Killmail._scan_file(key, manifest["files"][key]) for key in keys]
+            ).filter(pl.col("killmail_id").is_in(retained_ids))
+            staged = pl.concat([staged, retained])
+
+        # stream batches and files from older layouts are folded into the new file
+        batch_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        key = f"{prefix}{batch_id}.parquet"
+        Killmail._publish(
+            dataset,
+            tenant,
+            key,
+            Killmail._first_rows(staged, ["killmail_id", "attacker_character_id"]),
+            replaces=keys,
+            scope=(month, date),
+            base=base,
+        )
+        Killmail._put_index(dataset, tenant, date, staged_ids | retained_ids, [key])
+        return key, rows
+
+    @staticmethod
+    def compact(tenant: str, month: str, version: int | None = None) -> bool:
+        """Merges the daily files of a month into a single sorted file.
+
+        Stream batches appended to an already compacted month are folded into
+        its month file the same way.
+
+        :param tenant: The tenant to compact
+        :param month: The month to compact, as YYYY-MM
+        :param version: Dataset version to compact, the live one if None
+        :returns: True if a month file was written, False if there was nothing to merge
+        """
+        dataset = Killmail._dataset_prefix(version)
+        return Killmail._until_published(
+            dataset, tenant, (month, None), Killmail._compact, dataset, tenant, month
+        )
+
+    @staticmethod
+    def _compact(dataset: str, tenant: str, month: str) -> bool:
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        base = Killmail._partition_keys(manifest, dataset, tenant, month)
+        if not any("/date=" in key for key in base):
+            return False
+
+        killmails = pl.concat(
+            [Killmail._scan_file(key, manifest["files"][key]) for key in base]
+        )
+        month_ids = killmails.group_by("date").agg("killmail_id").collect()
+
+        # the month file holds nothing a consumer of the change feed has not
+        # seen in the files it merges, so it keeps their latest sequence
+        key = Killmail._write_month(
+            dataset,
+            tenant,
+            month,
+            killmails,
+            replaces=base,
+            scope=(month, None),
+            base=base,
+            sequence=max(manifest["files"][key].get("sequence", 0) for key in base),
+        )
+
+        # every day of the month is in the new file only
+        for date, ids in month_ids.iter_rows():
+            Killmail._put_index(dataset, tenant, date, set(ids), [key])
+        return True
+
+    @staticmethod
+    def get_uncompacted_months(tenant: str, version: int | None = None) -> list[str]:
+        """Lists the months that still have daily files.
+
+        :param tenant: The tenant to look at
+        :param version: Dataset version to look at, the live one if None
+        :returns: Months as YYYY-MM, oldest first
+        """
+        dataset = Killmail._dataset_prefix(version)
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        return sorted(
+            {
+                key.split("/date=", 1)[1][:7]
+                for key in manifest["files"]
+                if "/date=" in key
+            }
+        )
+
+    @staticmethod
+    def _write_month(
+        dataset: str,
+        tenant: str,
+        month: str,
+        killmails: pl.DataFrame | pl.LazyFrame,
+        replaces: list[str],
+        scope: tuple,
+        base: list[str],
+        sequence: int | None = None,
+    ) -> str:
+        batch_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        key = f"{dataset}/tenant={tenant}/month={month}/{batch_id}.parquet"
+        Killmail._publish(
+            dataset,
+            tenant,
+            key,
+            Killmail._first_rows(killmails, ["killmail_id", "attacker_character_id"]),
+            replaces=replaces,
+            scope=scope,
+            base=base,
+            profile=writeprofiles.COMPACTION_WRITE_PROFILE,
+            sequence=sequence,
+        )
+        return key
+
+    @staticmethod
+    def _partition_keys(
+        manifest: dict, dataset: str, tenant: str, month: str, date=None
+    ) -> list[str]:
+        """Lists the live files that can hold rows of a date, or of a month.
+
+        :param manifest: The manifest to look in
+        :param dataset: The dataset prefix
+        :param tenant: The tenant
+        :param month: The month, as YYYY-MM
+        :param date: The date, the whole month if None
+        :returns: The day files of the date (or month) and the month file, sorted
+        """
+        days = f"{dataset}/tenant={tenant}/" + (
+            f"date={date}/" if date is not None else f"date={month}-"
+        )
+        month_prefix = f"{dataset}/tenant={tenant}/month={month}/"
+        return sorted(
+            key
+            for key in manifest["files"]
+            if key.startswith(days) or key.startswith(month_prefix)
+        )
+
+    @staticmethod
+    def _month_file(manifest: dict, month: str) -> str | None:
+        return next(
+            (key for key in manifest["files"] if f"/month={month}/" in key), None
+        )
+
+    # data files are never overwritten: a new key is written, then the manifest
+    # update makes readers switch to it, then the superseded files are deleted
+    @staticmethod
+    def _publish(
+        dataset: str,
+        tenant: str,
+        key: str,
+        killmails: pl.DataFrame | pl.LazyFrame,
+        replaces: list[str],
+        scope: tuple,
+        base: list[str],
+        profile: str = writeprofiles.INGEST_WRITE_PROFILE,
+        sequence: int | None = None,
+    ) -> None:
+        stats = Killmail._describe(killmails)
+        killmails = writeprofiles.prepare(killmails, profile)
+        if sequence is not None:  # otherwise the manifest update assigns one
+            stats["sequence"] = sequence
+
+        # a merge fails while streaming when another writer deletes its input;
+        # what it wrote was never listed, so never read, and it is redone
+        # from scratch
+        try:
+            removed = Killmail._write_files(
+                dataset, tenant, key, killmails, stats, replaces, scope, base, profile
+            )
+        except Exception:
+            backend.delete(key)
+            if "participants" in stats:
+                backend.delete(stats["participants"])
+            raise
+
+        for replaced, replaced_stats in removed.items():
+            backend.delete(replaced)
+            if "participants" in replaced_stats:
+                backend.delete(replaced_stats["participants"])
+        return
+
+    # writes the data file (and participants file) and lists it in the
+    # manifest; returns the entries of the files it replaced
+    @staticmethod
+    def _write_files(
+        dataset: str,
+        tenant: str,
+        key: str,
+        killmails: pl.DataFrame | pl.LazyFrame,
+        stats: dict,
+        replaces: list[str],
+        scope: tuple,
+        base: list[str],
+        profile: str,
+    ) -> dict[str, dict]:
+        if STORAGE_MODE == "normalized":
+            stats["columns"] = killmails.collect_schema().names()
+            stats["participants"] = key.replace(".parquet", ".participants.parquet")
+
+            participants = killmails.select(PARTICIPATION_COLUMNS)
+            writeprofiles.write(
+                participants, backend.url(stats["participants"]), profile
+            )
+            stats["participants_etag"] = backend.head(stats["participants"])
+            stats["participants_bytes"] = Killmail._describe(participants)["bytes"]
+
+            killmails = Killmail._first_rows(
+                killmails.drop(PARTICIPATION_COLUMNS[1:]), ["killmail_id"]
+            )
+            stats["bytes"] = Killmail._describe(killmails)["bytes"]
+
+        writeprofiles.write(killmails, backend.url(key), profile)
+
+        # the ETag lets cached copies be validated without asking S3 again
+        stats["etag"] = backend.head(key)
+        return Killmail._update_manifest(
+            dataset, tenant, {key: stats}, replaces, scope, base
+        )
+
+    # keeps the first row of each key, in order; a streaming unique holds every
+    # whole row it keeps, this only the keys and row numbers, at the cost of
+    # reading the rows twice
+    @staticmethod
+    def _first_rows(
+        killmails: pl.DataFrame | pl.LazyFrame, keys: list[str]
+    ) -> pl.LazyFrame:
+        numbered = killmails.lazy().with_row_index("_row")
+        first = numbered.group_by(keys).agg(pl.col("_row").min())
+        return numbered.join(
+            first.select("_row"), on="_row", how="semi", maintain_order="left"
+        ).drop("_row")
+
+    @staticmethod
+    def _scan_file(key: str, stats: dict, cached: bool = False) -> pl.LazyFrame:
+        """Scans a data file listed in the manifest as KILLMAIL_SCHEMA rows.
+
+        :param key: The data file
+        :param stats: Its manifest entry
+        :param cached: Read through hotcache.HotCache
+        :returns: The file's rows, joined with its participation table if normalized
+        """
+
+        def scan(file_key: str, etag: str | None, size: int | None) -> pl.LazyFrame:
+            if cached:
+                return hotcache.HotCache.scan(backend.url(file_key), etag, size)
+            return pl.scan_parquet(backend.url(file_key), hive_partitioning=False)
+
+        killmails = scan(key, stats.get("etag"), stats.get("bytes"))
+        if "participants" not in stats:
+            return killmails
+
+        participants = scan(
+            stats["participants"],
+            stats.get("participants_etag"),
+            stats.get("participants_bytes"),
+        )
+        return killmails.join(participants, on="killmail_id").select(stats["columns"])
+
+    @staticmethod
+    def _describe(killmails: pl.DataFrame | pl.LazyFrame) -> dict:
+        """Computes the manifest statistics of a data file.
+
+        :param killmails: The rows of the file
+        :returns: Row count, min and max of each MANIFEST_STAT_COLUMNS column
+            present, and the bytes the rows take in memory, which is what a
+            hot cache entry of the file takes
+        """
+        killmails = killmails.lazy()
+        schema = killmails.collect_schema()
+        columns = [column for column in MANIFEST_STAT_COLUMNS if column in schema]
+
+        # fixed-width columns take the same bytes on every row, strings their
+        # length; counted without holding the rows
+        width = pl.select(
+            pl.lit(0).cast(dtype).alias(column)
+            for column, dtype in schema.items()
+            if dtype != pl.String
+        ).estimated_size()
+        size = pl.len().cast(pl.Int64) * width
+        for column, dtype in schema.items():
+            if dtype == pl.String:
+                size = size + pl.col(column).str.len_bytes().sum()
+
+        stats = (
+            killmails.select(
+                pl.len().alias("rows"),
+                size.alias("bytes"),
+                *[pl.col(column).min().alias(f"min:{column}") for column in columns],
+                *[pl.col(column).max().alias(f"max:{column}") for column in columns],
+            )
+            .collect()
+            .row(0, named=True)
+        )
+
+        # dates are kept as ISO strings, which order the same way
+        def value(column: str, stat: str):
+            found = stats[f"{stat}:{column}"]
+            return str(found) if column == "date" and found is not None else found
+
+        return {
+            "rows": stats["rows"],
+            "bytes": stats["bytes"],
+            "min": {column: value(column, "min") for column in columns},
+            "max": {column: value(column, "max") for column in columns},
+        }
+
+    @staticmethod
+    def _get_manifest(dataset: str, tenant: str) -> tuple[dict, str]:
+        """Reads the list of live data files of a tenant.
+
+        :param dataset: The dataset prefix
+        :param tenant: The tenant
+        :returns: The manifest and its ETag, for a conditional update
+        """
+        key = f"{INDEX_PREFIX}/{dataset}/tenant={tenant}/manifest.json"
+
+        while True:
+            if stored := backend.get(key):
+                content, etag = stored
+                return json.loads(content), etag
+
+            # datasets written before manifests existed are listed once
+            manifest = {"sequence": 1, "files": {}}
+            data_keys = backend.list(f"{dataset}/tenant={tenant}/")
+            for data_key in data_keys:
+                if not data_key.endswith(".parquet") or data_key.endswith(
+                    ".participants.parquet"
+                ):
+                    continue
+
+                stats = {"etag": backend.head(data_key), "sequence": 1}
+                participants = data_key.replace(".parquet", ".participants.parquet")
+                if participants in data_keys:
+                    stats["participants"] = participants
+                    stats["participants_etag"] = backend.head(participants)
+                    stats["columns"] = (
+                        list(pl.read_parquet_schema(backend.url(data_key)))
+                        + PARTICIPATION_COLUMNS[1:]
+                    )
+
+                stats |= Killmail._describe(Killmail._scan_file(data_key, stats))
+                manifest["files"][data_key] = stats
+
+            try:
+                etag = backend.put(
+                    key, json.dumps(manifest).encode("utf-8"), if_none_match=True
+                )
+                return manifest, etag
+            except storage.ConditionFailed:
+                pass
+
+    # optimistic: an update that lost the race is applied again to the manifest
+    # that won, as long as that one did not touch the merged partition. Every
+    # update takes the next sequence number, which the files it adds record
+    # for the change feed.
+    @staticmethod
+    def _update_manifest(
+        dataset: str,
+        tenant: str,
+        add: dict[str, dict],
+        remove: list[str],
+        scope: tuple,
+        base: list[str],
+    ) -> dict[str, dict]:
+        """Swaps files in a manifest, if the files they were merged from are live.
+
+        :param dataset: The dataset prefix
+        :param tenant: The tenant
+        :param add: Manifest entries of the new files
+        :param remove: The files the new ones supersede
+        :param scope: (month, date) of the merged partition, date None for a month
+        :param base: The files of the partition when the merge read it
+        :returns: The manifest entries of the removed files
+        :raises ManifestConflict: If the partition's files changed since the merge
+        """
+        while True:
+            manifest, etag = Killmail._get_manifest(dataset, tenant)
+            if any(key not in manifest["files"] for key in remove) or (
+                Killmail._partition_keys(manifest, dataset, tenant, *scope) != base
+            ):
+                raise ManifestConflict(f"{dataset}/tenant={tenant} {scope}")
+
+            removed = {
+                key: manifest["files"].pop(key)
+                for key in remove
+                if key in manifest["files"]
+            }
+            manifest["sequence"] = manifest.get("sequence", 0) + 1
+            manifest["files"].update(
+                {
+                    key: {"sequence": manifest["sequence"], **stats}
+                    for key, stats in add.items()
+                }
+            )
+
+            try:
+                backend.put(
+                    f"{INDEX_PREFIX}/{dataset}/tenant={tenant}/manifest.json",
+                    json.dumps(manifest).encode("utf-8"),
+                    if_match=etag,
+                )
+                return removed
+            except storage.ConditionFailed:
+                pass
+
+    # False when the file statistics prove no row can fall within the bounds
+    @staticmethod
+    def _overlaps(stats: dict, where: dict[str, tuple]) -> bool:
+        for column, bounds in where.items():
+            low, high = (
+                bound.isoformat() if hasattr(bound, "isoformat") else bound
+                for bound in bounds
+            )
+            if stats["min"][column] is None:
+                return False
+            if low is not None and stats["max"][column] < low:
+                return False
+            if high is not None and stats["min"][column] > high:
+                return False
+        return True
+
+    @staticmethod
+    def _get_index(dataset: str, tenant: str, date, manifest: dict) -> set[int]:
+        """Reads the killmail ids stored in a partition.
+
+        :param dataset: The dataset prefix
+        :param tenant: The partition tenant
+        :param date: The partition date
+        :param manifest: The manifest the caller merges against
+        :returns: The killmail ids the manifest's files hold for the date; the
+            files are only read when the index was written for other files
+        """
+        keys = Killmail._partition_keys(manifest, dataset, tenant, str(date)[:7], date)
+
+        # an index written by a writer that lost a race, or before another
+        # writer swapped the files, describes files that are no longer live
+        if stored := backend.get(
+            f"{INDEX_PREFIX}/{dataset}/tenant={tenant}/date={date}.json"
+        ):
+            content, _ = stored
+            index = json.loads(content)
+            if index.get("files") == keys:
+                return set(index["killmail_ids"])
+
+        if not keys:
+            return set()
+
+        return set(
+            pl.concat(
+                [Killmail._scan_file(key, manifest["files"][key]) for key in keys]
+            )
+            .filter(pl.col("date") == date)
+            .select("killmail_id")
+            .collect()["killmail_id"]
+        )
+
+    @staticmethod
+    def _put_index(
+        dataset: str, tenant: str, date, killmail_ids: set[int], files: list[str]
+    ) -> None:
+        backend.put(
+            f"{INDEX_PREFIX}/{dataset}/tenant={tenant}/date={date}.json",
+            json.dumps(
+                {"killmail_ids": sorted(killmail_ids), "files": sorted(files)}
+            ).encode("utf-8"),
+        )
+        return
+
+    @staticmethod
+    def get_version() -> int:
+        if stored := backend.get(DATASET_POINTER_KEY):
+            content, _ = stored
+            return json.loads(content)["version"]
+        return 1
+
+    @staticmethod
+    def set_version(version: int) -> None:
+        backend.put(
+            DATASET_POINTER_KEY, json.dumps({"version": version}).encode("utf-8")
+        )
+        return
+
+    @staticmethod
+    def _dataset_prefix(version: int | None = None) -> str:
+        if version is None:
+            version = Killmail.get_version()
+
+        return "killmails" if version == 1 else f"killmails-v{version}"
+
+    @staticmethod
+    def append_stream_batch(
+        killmails: pl.DataFrame, version: int | None = None
+    ) -> None:
+        """Adds streamed killmails to their partitions, next to the daily files.
+
+        Killmails already in a partition's index are dropped, so a batch never
+        duplicates what the daily ingest or an earlier batch wrote, and the
+        next upsert of the date folds the batch files into its data file.
+
+        :param killmails: KILLMAIL_SCHEMA rows from the live feed
+        :param version: Dataset version the rows belong to, the live one if None
+        """
+        dataset = Killmail._dataset_prefix(version)
+        batch_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+
+        for (tenant, date), partition in killmails.partition_by(
+            ["tenant", "date"], as_dict=True
+        ).items():
+            Killmail._until_published(
+                dataset,
+                tenant,
+                (str(date)[:7], date),
+                Killmail._append_partition,
+                dataset,
+                tenant,
+                date,
+                partition,
+                batch_id,
+            )
+        return
+
+    @staticmethod
+    def _append_partition(
+        dataset: str, tenant: str, date, partition: pl.DataFrame, batch_id: str
+    ) -> None:
+        month = str(date)[:7]
+
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        base = Killmail._partition_keys(manifest, dataset, tenant, month, date)
+
+        existing_ids = Killmail._get_index(dataset, tenant, date, manifest)
+        partition = partition.filter(~pl.col("killmail_id").is_in(existing_ids))
+        if not partition.height:
+            return
+
+        key = f"{dataset}/tenant={tenant}/date={date}/stream-{batch_id}.parquet"
+        Killmail._publish(
+            dataset,
+            tenant,
+            key,
+            partition,
+            replaces=[],
+            scope=(month, date),
+            base=base,
+        )
+        Killmail._put_index(
+            dataset,
+            tenant,
+            date,
+            existing_ids | set(partition["killmail_id"]),
+            base + [key],
+        )
+        return
+
+    @staticmethod
+    def get(
+        tenant: str = DEFAULT_TENANT,
+        start: date | None = None,
+        end: date | None = None,
+        columns: list[str] | None = None,
+        where: dict[str, tuple] | None = None,
+        version: int | None = None,
+    ) -> pl.LazyFrame:
+        """Scans the killmails of a tenant, planned from its manifest.
+
+        Only the files whose statistics can match the date range and bounds are
+        opened, and the filters and projection are pushed into each of them.
+
+        :param tenant: The tenant to read
+        :param start: First date to read, inclusive, unbounded if None
+        :param end: Last date to read, inclusive, unbounded if None
+        :param columns: Columns to read, all of them if None
+        :param where: Inclusive (low, high) bounds on MANIFEST_STAT_COLUMNS, None
+            for an open end
+        :param version: Dataset version to read, the live one if None
+        :returns: KILLMAIL_SCHEMA rows within the range and bounds
+        """
+        bounds = dict(where or {})
+        if start is not None or end is not None:
+            bounds["date"] = (start, end)
+
+        predicates = [
+            predicate
+            for column, (low, high) in bounds.items()
+            for predicate in [
+                pl.col(column) >= low if low is not None else None,
+                pl.col(column) <= high if high is not None else None,
+            ]
+            if predicate is not None
+        ]
+
+        def read(killmails: pl.LazyFrame) -> pl.LazyFrame:
+            if predicates:
+                killmails = killmails.filter(predicates)
+            return killmails.select(columns) if columns else killmails
+
+        dataset = Killmail._dataset_prefix(version)
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+
+        keys = [
+            key
+            for key, stats in manifest["files"].items()
+            if Killmail._overlaps(stats, bounds)
+        ]
+        if not keys and manifest["files"]:
+            # nothing to read, any file still provides the schema
+            key, stats = next(iter(manifest["files"].items()))
+            return read(Killmail._scan_file(key, stats).head(0))
+        if not keys:  # nothing written yet
+            return read(pl.LazyFrame(schema=everef.KILLMAIL_SCHEMA))
+
+        # warm containers read the files they already fetched from local disk
+        return pl.concat(
+            [
+                read(Killmail._scan_file(key, manifest["files"][key], cached=True))
+                for key in keys
+            ]
+        )
+
+    @staticmethod
+    def get_changes(
+        tenant: str = DEFAULT_TENANT,
+        since: int | None = None,
+        columns: list[str] | None = None,
+        version: int | None = None,
+    ) -> tuple[pl.LazyFrame, int]:
+        """Scans what was committed after a watermark, for incremental consumers.
+
+        Changes come by date: every date a file committed after the watermark
+        holds is returned whole, with its current rows from all the files it
+        is spread over, stream batches included. Consumers replace the dates
+        returned rather than add them. Watermarks are per tenant and dataset
+        version.
+
+        :param tenant: The tenant to read
+        :param since: The watermark returned by the previous call, None for everything
+        :param columns: Columns to read, all of them if None
+        :param version: Dataset version to read, the live one if None
+        :returns: KILLMAIL_SCHEMA rows of the dates changed after the
+            watermark, and the watermark to pass next time
+        """
+        dataset = Killmail._dataset_prefix(version)
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        watermark = manifest.get("sequence", 0)
+
+        # a stream batch or a month file holds only part of some dates, the
+        # other files of those dates are read with it
+        changed = set()
+        for stats in manifest["files"].values():
+            if since is not None and stats.get("sequence", 0) > since:
+                day = date.fromisoformat(stats["min"]["date"])
+                while day <= date.fromisoformat(stats["max"]["date"]):
+                    changed.add(day)
+                    day += timedelta(days=1)
+
+        def read(killmails: pl.LazyFrame) -> pl.LazyFrame:
+            if since is not None:
+                killmails = killmails.filter(pl.col("date").is_in(sorted(changed)))
+            return killmails.select(columns) if columns else killmails
+
+        keys = (
+            list(manifest["files"])
+            if since is None
+            else sorted(
+                {
+                    key
+                    for day in changed
+                    for key in Killmail._partition_keys(
+                        manifest, dataset, tenant, str(day)[:7], day
+                    )
+                }
+            )
+        )
+        if not keys and manifest["files"]:
+            # nothing changed, any file still provides the schema
+            key, stats = next(iter(manifest["files"].items()))
+            return read(Killmail._scan_file(key, stats).head(0)), watermark
+        if not keys:  # nothing written yet
+            return read(pl.LazyFrame(schema=everef.KILLMAIL_SCHEMA)), watermark
+
+        changes = pl.concat(
+            [
+                read(Killmail._scan_file(key, manifest["files"][key], cached=True))
+                for key in keys
+            ]
+        )
+        return changes, watermark
+
+    @staticmethod
+    def set_ingest_stats(stats: dict) -> None:
+        backend.put("killmail-ingest-stats.json", json.dumps(stats).encode("utf-8"))
+        return
+
+    @staticmethod
+    def get_ingest_stats() -> dict:
+        if stored := backend.get("killmail-ingest-stats.json"):
+            content, _ = stored
+            return json.loads(content)
+        return {}
+
+
+class KillmailRollup:
+    """
+    Killmail counts per character, ship type and is_loss, by day and by month,
+    so leaderboards read a few pre-aggregated rows instead of killmail rows.
+
+    Kills are counted for the attacker and its ship, losses for the victim and
+    its ship. Each killmail counts once per row, and killmail_count keeps
+    character_victim_count apart for kills of structures and NPCs.
+
+    With ROLLUP_SKETCHES, rows also carry a killmail_sketch that count_distinct
+    merges for approximate counts; leaderboards keep summing the exact counts.
+    """
+
+    @staticmethod
+    def update(tenant: str, dates: list[date], version: int | None = None) -> None:
+        """Recomputes the rollups of the given dates from the killmail rows.
+
+        Only the touched dates are read; the monthly rows of their months are
+        then summed again from the daily ones.
+
+        :param tenant: The tenant whose rollups to update
+        :param dates: The dates whose killmails changed
+        :param version: Dataset version to read, the live one if None
+        """
+        dataset = Killmail._dataset_prefix(version)
+
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        if not manifest["files"]:
             return
 
-        killmails.collect().write_parquet(
-            f"s3://{DATALAKE_BUCKET}/killmails", partition_by=["date"]
+        months = {}
+        for day in dates:
+            months.setdefault(day.replace(day=1), []).append(day)
+
+        recomputed = []
+        for month, days in months.items():
+            key = f"rollups/{dataset}/daily/tenant={tenant}/month={month:%Y-%m}.parquet"
+
+            daily = KillmailRollup._aggregate(
+                Killmail.get(
+                    tenant, start=min(days), end=max(days), version=version
+                ).filter(pl.col("date").is_in(days))
+            )
+            # rows written before sketches were enabled have none, relaxed
+            # concatenation leaves them null
+            previous = KillmailRollup._read(key)
+            if previous is not None:
+                daily = pl.concat(
+                    [previous.filter(~pl.col("date").is_in(days)), daily],
+                    how="diagonal_relaxed",
+                )
+            KillmailRollup._write(key, daily.sort(ROLLUP_KEYS))
+
+            monthly = daily.group_by(ROLLUP_KEYS[1:]).agg(pl.col(ROLLUP_MEASURES).sum())
+            if ROLLUP_SKETCHES:
+                monthly = monthly.join(
+                    KillmailRollup._merge_sketches(
+                        daily.lazy(), ROLLUP_KEYS[1:]
+                    ).collect(),
+                    on=ROLLUP_KEYS[1:],
+                    how="left",
+                    nulls_equal=True,
+                )
+            recomputed.append(monthly.select(pl.lit(month).alias("month"), pl.all()))
+
+        # months recomputed above replace their previous rows
+        key = f"rollups/{dataset}/monthly/tenant={tenant}.parquet"
+        previous = KillmailRollup._read(key)
+        if previous is not None:
+            recomputed.append(previous.filter(~pl.col("month").is_in(list(months))))
+        KillmailRollup._write(
+            key,
+            pl.concat(recomputed, how="diagonal_relaxed").sort(
+                ["month"] + ROLLUP_KEYS[1:]
+            ),
         )
         return
 
-    def get() -> pl.LazyFrame:
-        return pl.scan_parquet(f"s3://{DATALAKE_BUCKET}/killmails/")
+    @staticmethod
+    def get(
+        tenant: str = DEFAULT_TENANT,
+        granularity: str = "monthly",
+        start: date | None = None,
+        end: date | None = None,
+        version: int | None = None,
+    ) -> pl.LazyFrame:
+        """Reads rollup rows.
+
+        :param tenant: The tenant to read
+        :param granularity: "daily" (keyed by date) or "monthly" (keyed by the
+            first day of the month)
+        :param start: First day to read, inclusive, unbounded if None
+        :param end: Last day to read, inclusive, unbounded if None
+        :param version: Dataset version the rollups were built from, the live one if None
+        :returns: Rows of ROLLUP_KEYS and ROLLUP_MEASURES
+        """
+        dataset = Killmail._dataset_prefix(version)
+
+        if granularity == "monthly":
+            key_column = "month"
+            keys = [f"rollups/{dataset}/monthly/tenant={tenant}.parquet"]
+            start = start.replace(day=1) if start else None
+        else:
+            key_column = "date"
+            keys = [
+                key
+                for key in backend.list(f"rollups/{dataset}/daily/tenant={tenant}/")
+                if (start is None or key[-15:-8] >= f"{start:%Y-%m}")
+                and (end is None or key[-15:-8] <= f"{end:%Y-%m}")
+            ]
+
+        frames = [
+            frame for frame in map(KillmailRollup._read, keys) if frame is not None
+        ]
+        if not frames:
+            return pl.LazyFrame(schema={key_column: pl.Date, **ROLLUP_SCHEMA})
+
+        rollup = pl.concat(frames, how="diagonal_relaxed").lazy()
+        if start is not None:
+            rollup = rollup.filter(pl.col(key_column) >= start)
+        if end is not None:
+            rollup = rollup.filter(pl.col(key_column) <= end)
+        return rollup
+
+    @staticmethod
+    def count_distinct(
+        start: date,
+        end: date,
+        by: list[str],
+        where: pl.Expr | None = None,
+        approximate: bool = True,
+        tenant: str = DEFAULT_TENANT,
+        version: int | None = None,
+    ) -> pl.DataFrame:
+        """Counts distinct killmails per group over any window.
+
+        The approximate path merges the sketches of the monthly rows of the
+        months the window covers whole and of the daily rows of the rest, and
+        needs rollups built with ROLLUP_SKETCHES. The exact path reads the
+        killmail rows of the window, as the official awards do.
+
+        :param start: First day of the window, inclusive
+        :param end: Last day of the window, inclusive
+        :param by: Rollup key columns to count per, e.g. ["is_loss"] for all
+            characters together, or [] for the whole window
+        :param where: Filter on the rollup keys, e.g. characters or ship types
+        :param approximate: Estimate from the sketches instead of reading killmails
+        :param tenant: The tenant to read
+        :param version: Dataset version to read, the live one if None
+        :returns: by, killmail_count and killmail_count_low/high, the bounds of
+            two standard errors (about 95%); exact counts have no spread
+        :raises ValueError: If approximate and a rollup row of the window has no
+            sketch, i.e. was built before ROLLUP_SKETCHES was enabled
+        """
+        # group_by needs a key, the whole window is grouped on a constant one
+        keys = by or ["window"]
+
+        if not approximate:
+            participations = KillmailRollup._participations(
+                Killmail.get(tenant, start=start, end=end, version=version)
+            ).with_columns(pl.lit(True).alias("window"))
+            if where is not None:
+                participations = participations.filter(where)
+            return (
+                participations.group_by(keys)
+                .agg(pl.col("killmail_id").n_unique().alias("killmail_count"))
+                .select(
+                    *by,
+                    "killmail_count",
+                    pl.col("killmail_count").alias("killmail_count_low"),
+                    pl.col("killmail_count").alias("killmail_count_high"),
+                )
+                .collect()
+            )
+
+        # months the window covers entirely are read from the monthly rows
+        months, month = [], start.replace(day=1)
+        while month <= end:
+            following = (month + timedelta(days=31)).replace(day=1)
+            if month >= start and following - timedelta(days=1) <= end:
+                months.append(month)
+            month = following
+
+        monthly = KillmailRollup.get(tenant, "monthly", start, end, version).filter(
+            pl.col("month").is_in(months)
+        )
+        daily = KillmailRollup.get(tenant, "daily", start, end, version).filter(
+            ~pl.col("date").dt.truncate("1mo").is_in(months)
+        )
+        rows = pl.concat(
+            [frame.drop("month", "date", strict=False) for frame in (monthly, daily)],
+            how="diagonal_relaxed",
+        )
+        if "killmail_sketch" not in rows.collect_schema():
+            rows = rows.with_columns(
+                pl.lit(None, pl.List(pl.UInt32)).alias("killmail_sketch")
+            )
+        if where is not None:
+            rows = rows.filter(where)
+        rows = rows.with_columns(pl.lit(True).alias("window"))
+
+        # merging what sketches there are would silently leave rows out
+        if rows.select(pl.col("killmail_sketch").is_null().any()).collect().item():
+            raise ValueError(
+                "Rollup rows without sketches in the window, rebuild them with ROLLUP_SKETCHES"
+            )
+
+        registers = 1 << SKETCH_PRECISION
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        spread = 2 * 1.04 / math.sqrt(registers)
+
+        estimates = (
+            KillmailRollup._merge_sketches(rows, keys)
+            .explode("killmail_sketch")
+            .drop_nulls("killmail_sketch")
+            .group_by(keys)
+            .agg(
+                pl.len().alias("used"),
+                pl.lit(2.0)
+                .pow(-(pl.col("killmail_sketch") % 64).cast(pl.Float64))
+                .sum()
+                .alias("sum"),
+            )
+            .with_columns((registers - pl.col("used")).alias("empty"))
+            .with_columns(
+                # few distinct killmails: linear counting of the empty registers
+                pl.when(
+                    (pl.col("empty") > 0)
+                    & (
+                        alpha * registers**2 / (pl.col("sum") + pl.col("empty"))
+                        <= 2.5 * registers
+                    )
+                )
+                .then(registers * (registers / pl.col("empty")).log())
+                .otherwise(alpha * registers**2 / (pl.col("sum") + pl.col("empty")))
+                .alias("estimate")
+            )
+        )
+
+        return estimates.select(
+            *by,
+            pl.col("estimate").round().cast(pl.UInt32).alias("killmail_count"),
+            (pl.col("estimate") * (1 - spread))
+            .floor()
+            .cast(pl.UInt32)
+            .alias("killmail_count_low"),
+            (pl.col("estimate") * (1 + spread))
+            .ceil()
+            .cast(pl.UInt32)
+            .alias("killmail_count_high"),
+        ).collect()
+
+    # the union of sketches keeps the highest rank seen for each register; a
+    # group with rows built before sketches were enabled gets none, since its
+    # union would leave those rows out
+    @staticmethod
+    def _merge_sketches(rows: pl.LazyFrame, by: list[str]) -> pl.LazyFrame:
+        rows = rows.select(*by, "killmail_sketch")
+        complete = (
+            rows.group_by(by)
+            .agg(pl.col("killmail_sketch").is_not_null().all().alias("complete"))
+            .filter("complete")
+            .select(by)
+        )
+        return (
+            rows.explode("killmail_sketch")
+            .drop_nulls("killmail_sketch")
+            .group_by(*by, (pl.col("killmail_sketch") // 64).alias("register"))
+            .agg((pl.col("killmail_sketch") % 64).max().alias("rank"))
+            .group_by(by)
+            .agg(
+                (pl.col("register") * 64 + pl.col("rank"))
+                .cast(pl.UInt32)
+                .alias("killmail_sketch")
+            )
+            .join(complete, on=by, how="semi", nulls_equal=True)
+        )
+
+    # a stable hash, since sketches outlive the polars version that built them
+    @staticmethod
+    def _sketch_entry(killmail_id: int) -> int:
+        digest = hashlib.blake2b(killmail_id.to_bytes(8, "little"), digest_size=8)
+        value = int.from_bytes(digest.digest(), "little")
+
+        width = 64 - SKETCH_PRECISION
+        register = value >> width
+        rank = width - (value & ((1 << width) - 1)).bit_length() + 1
+        return register * 64 + rank
+
+    @staticmethod
+    def _aggregate(killmails: pl.LazyFrame) -> pl.DataFrame:
+        participations = KillmailRollup._participations(killmails)
+
+        measures = [
+            pl.col("killmail_id").n_unique().alias("killmail_count"),
+            pl.col("killmail_id")
+            .filter(pl.col("victim_character_id").is_not_null())
+            .n_unique()
+            .alias("character_victim_count"),
+        ]
+        if ROLLUP_SKETCHES:
+            # hashed once per killmail, not once per participation
+            killmail_ids = (
+                participations.select(pl.col("killmail_id").unique())
+                .collect()
+                .to_series()
+            )
+            entries = pl.DataFrame(
+                {
+                    "killmail_id": killmail_ids,
+                    "killmail_sketch": [
+                        KillmailRollup._sketch_entry(killmail_id)
+                        for killmail_id in killmail_ids
+                    ],
+                },
+                schema_overrides={"killmail_sketch": pl.UInt32},
+            )
+            participations = participations.join(entries.lazy(), on="killmail_id")
+            measures.append(pl.col("killmail_sketch").unique())
+
+        return (
+            participations.group_by(ROLLUP_KEYS)
+            .agg(measures)
+            .cast(ROLLUP_SCHEMA)
+            .collect()
+        )
 
+    # kills are credited to the attacker and its ship, losses to the victim
     @staticmethod
-    def set_totals(totals: dict) -> None:
-        s3_client.put_object(
-            Bucket=DATALAKE_BUCKET,
-            Key="killmail-totals.json",
-            Body=json.dumps(totals),
+    def _participations(killmails: pl.LazyFrame) -> pl.LazyFrame:
+        kills = killmails.filter(~pl.col("is_loss")).select(
+            "date",
+            pl.col("attacker_character_id").alias("character_id"),
+            pl.col("attacker_ship_type_id").alias("ship_type_id"),
+            "is_loss",
+            "killmail_id",
+            "victim_character_id",
         )
+        losses = killmails.filter(pl.col("is_loss")).select(
+            "date",
+            pl.col("victim_character_id").alias("character_id"),
+            pl.col("victim_ship_type_id").alias("ship_type_id"),
+            "is_loss",
+            "killmail_id",
+            "victim_character_id",
+        )
+        return pl.concat([kills, losses])
+
+    @staticmethod
+    def _read(key: str) -> pl.DataFrame | None:
+        if stored := backend.get(key):
+            content, _ = stored
+            return pl.read_parquet(io.BytesIO(content))
+        return None
+
+    @staticmethod
+    def _write(key: str, rollup: pl.DataFrame) -> None:
+        buffer = io.BytesIO()
+        rollup.write_parquet(buffer)
+        backend.put(key, buffer.getvalue())
+        return
+
+
+class ActivityIndex:
+    """
+    The days each character appeared on a killmail, as attacker or victim, kept
+    as one bitmap per character so activity, streak and inactivity questions
+    over every character are answered with integer AND, OR and bit counts
+    instead of scans of killmail rows.
+
+    Bitmaps are stored per tenant in a Parquet file next to the manifest, as
+    little-endian bytes in a zstd-compressed column, which packs the long runs
+    of inactive days the way a compressed bitmap format would.
+    """
+
+    @staticmethod
+    def update(tenant: str, dates: list[date], version: int | None = None) -> None:
+        """Recomputes the bits of the given dates from the killmail rows.
+
+        :param tenant: The tenant whose index to update
+        :param dates: The dates whose killmails changed
+        :param version: Dataset version to read, the live one if None
+        """
+        dataset = Killmail._dataset_prefix(version)
+
+        manifest, _ = Killmail._get_manifest(dataset, tenant)
+        if not manifest["files"] or not dates:
+            return
+
+        killmails = Killmail.get(
+            tenant,
+            start=min(dates),
+            end=max(dates),
+            columns=["date", "attacker_character_id", "victim_character_id"],
+            version=version,
+        ).filter(pl.col("date").is_in(dates))
+
+        appearances = (
+            pl.concat(
+                [
+                    killmails.select(
+                        "date", pl.col("attacker_character_id").alias("character_id")
+                    ),
+                    killmails.select(
+                        "date", pl.col("victim_character_id").alias("character_id")
+                    ),
+                ]
+            )
+            .drop_nulls()
+            .select(
+                "character_id",
+                (pl.col("date") - ACTIVITY_EPOCH).dt.total_days().alias("day"),
+            )
+            .unique()
+            .group_by("character_id")
+            .agg("day")
+            .collect()
+        )
+
+        # the touched days are cleared for everyone, then set from the rows
+        touched = ActivityIndex._mask(dates)
+        bitmaps = {
+            character_id: bitmap & ~touched
+            for character_id, bitmap in ActivityIndex.get(tenant, version).items()
+        }
+        for character_id, days in appearances.iter_rows():
+            bitmaps[character_id] = bitmaps.get(character_id, 0) | sum(
+                1 << day for day in days
+            )
+
+        bitmaps = {
+            character_id: bitmap for character_id, bitmap in bitmaps.items() if bitmap
+        }
+        KillmailRollup._write(
+            f"{INDEX_PREFIX}/{dataset}/tenant={tenant}/activity.parquet",
+            pl.DataFrame(
+                {
+                    "character_id": list(bitmaps),
+                    "days": [
+                        bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+                        for bitmap in bitmaps.values()
+                    ],
+                },
+                schema={"character_id": pl.UInt32, "days": pl.Binary},
+            ).sort("character_id"),
+        )
+        return
+
+    @staticmethod
+    def get(tenant: str = DEFAULT_TENANT, version: int | None = None) -> dict[int, int]:
+        """Reads the activity bitmaps of a tenant.
+
+        :param tenant: The tenant to read
+        :param version: Dataset version the index was built from, the live one if None
+        :returns: A bitmap per character id, bit n set for ACTIVITY_EPOCH + n days
+        """
+        dataset = Killmail._dataset_prefix(version)
+        index = KillmailRollup._read(
+            f"{INDEX_PREFIX}/{dataset}/tenant={tenant}/activity.parquet"
+        )
+        if index is None:
+            return {}
+
+        return {
+            character_id: int.from_bytes(days, "little")
+            for character_id, days in index.iter_rows()
+        }
+
+    @staticmethod
+    def active_days(
+        start: date,
+        end: date,
+        characters: list[int] | None = None,
+        tenant: str = DEFAULT_TENANT,
+        version: int | None = None,
+    ) -> dict[int, int]:
+        """Counts the days each character was active within a range.
+
+        :param start: First day of the range, inclusive
+        :param end: Last day of the range, inclusive
+        :param characters: Characters to count, every indexed one if None
+        :param tenant: The tenant to read
+        :param version: Dataset version the index was built from, the live one if None
+        :returns: Active days per character; characters never seen count 0
+        """
+        bitmaps = ActivityIndex.get(tenant, version)
+        window = ActivityIndex._range(start, end)
+
+        return {
+            character_id: (bitmaps.get(character_id, 0) & window).bit_count()
+            for character_id in (bitmaps if characters is None else characters)
+        }
+
+    @staticmethod
+    def longest_streaks(
+        start: date,
+        end: date,
+        characters: list[int] | None = None,
+        tenant: str = DEFAULT_TENANT,
+        version: int | None = None,
+    ) -> dict[int, int]:
+        """Finds each character's longest run of consecutive active days in a range.
+
+        :param start: First day of the range, inclusive
+        :param end: Last day of the range, inclusive
+        :param characters: Characters to look at, every indexed one if None
+        :param tenant: The tenant to read
+        :param version: Dataset version the index was built from, the live one if None
+        :returns: Length of the longest streak per character, 0 if never active
+        """
+        bitmaps = ActivityIndex.get(tenant, version)
+        window = ActivityIndex._range(start, end)
+
+        streaks = {}
+        for character_id in bitmaps if characters is None else characters:
+            # each step drops the last day of every run, the number of steps
+            # until nothing is left is the longest run
+            bitmap, streak = bitmaps.get(character_id, 0) & window, 0
+            while bitmap:
+                bitmap &= bitmap >> 1
+                streak += 1
+            streaks[character_id] = streak
+        return streaks
+
+    @staticmethod
+    def inactive(
+        since: date,
+        characters: list[int] | None = None,
+        tenant: str = DEFAULT_TENANT,
+        version: int | None = None,
+    ) -> dict[int, date | None]:
+        """Finds the characters who have not appeared on a killmail since a date.
+
+        :param since: First day that counts as active, e.g. 60 days ago
+        :param characters: Characters to check, every indexed one if None
+        :param tenant: The tenant to read
+        :param version: Dataset version the index was built from, the live one if None
+        :returns: The last active day of each inactive character, None if never seen
+        """
+        bitmaps = ActivityIndex.get(tenant, version)
+        first_day = (since - ACTIVITY_EPOCH).days
+
+        last_active = {}
+        for character_id in bitmaps if characters is None else characters:
+            bitmap = bitmaps.get(character_id, 0)
+            if bitmap >> first_day:
+                continue
+            last_active[character_id] = (
+                ACTIVITY_EPOCH + timedelta(days=bitmap.bit_length() - 1)
+                if bitmap
+                else None
+            )
+        return last_active
+
+    @staticmethod
+    def _mask(dates: list[date]) -> int:
+        mask = 0
+        for day in dates:
+            mask |= 1 << (day - ACTIVITY_EPOCH).days
+        return mask
+
+    @staticmethod
+    def _range(start: date, end: date) -> int:
+        first, last = (start - ACTIVITY_EPOCH).days, (end - ACTIVITY_EPOCH).days
+        return ((1 << (last - first + 1)) - 1) << first
+
+
+class RawKillmail:
+    """
+    Full-fidelity copy of every killmail in the archives, split into the
+    "killmails", "attackers" and "items" datasets joined by killmail_id.
+    """
+
+    @staticmethod
+    def upsert(tables: dict[str, pl.DataFrame]) -> None:
+        for name, table in tables.items():
+            table.write_parquet(backend.url(f"raw/{name}"), partition_by=["date"])
+        return
+
+    @staticmethod
+    def get(table: str) -> pl.LazyFrame:
+        return pl.scan_parquet(backend.url(f"raw/{table}/"))
+
+
+class IngestLedger:
+    """
+    What the killmail ingest wrote for each date, keyed YYYYMMDD: everef's
+    killmail count for the archive that was read, the rows written, the data
+    files holding them and the SHA-256 of the archive.
+
+    Entries are stored in one object per year, each changed with a conditional
+    write, so concurrent ingesters can claim dates before fetching them and
+    commit them without overwriting each other's entries.
+
+    A committed date stays rollup_pending until its rollups and activity bits
+    are rebuilt, so dates committed by an ingester that failed before getting
+    there are caught up by the next one. Rebuilds are serialized by a lease.
+    """
+
+    @staticmethod
+    def get(version: int | None = None) -> dict[str, dict]:
+        """Reads every entry of a dataset version.
+
+        :param version: Dataset version the entries describe, the live one if None
+        :returns: Entries keyed by date; dates seeded from TOTALS_KEY only have
+            their source_count
+        """
+        dataset = Killmail._dataset_prefix(version)
+        keys = backend.list(f"{INDEX_PREFIX}/{dataset}/ledger/")
+        if not keys and dataset == "killmails":
+            IngestLedger._seed(dataset)
+            keys = backend.list(f"{INDEX_PREFIX}/{dataset}/ledger/")
+
+        entries = {}
+        for key in keys:
+            entries.update(IngestLedger._read(key)[0])
+        return entries
+
+    @staticmethod
+    def diff(remote_totals: dict, version: int | None = None) -> dict[str, int]:
+        """Finds the dates whose everef count differs from what was ingested.
+
+        :param remote_totals: everef's killmail count per date, keyed YYYYMMDD
+        :param version: Dataset version to compare with, the live one if None
+        :returns: The ingested count of each date to fetch, 0 if never ingested;
+            dates claimed by a running ingester are left out
+        """
+        entries = IngestLedger.get(version)
+        now = datetime.now(timezone.utc)
+
+        return {
+            date: entries.get(date, {}).get("source_count", 0)
+            for date, count in remote_totals.items()
+            if count > 0
+            and count != entries.get(date, {}).get("source_count")
+            and not IngestLedger._is_claimed(entries.get(date, {}), None, now)
+        }
+
+    @staticmethod
+    def claim(
+        totals: dict[str, int],
+        owner: str,
+        ttl: timedelta = INGEST_CLAIM_TTL,
+        version: int | None = None,
+    ) -> list[str]:
+        """Reserves dates for one ingester until it commits or releases them.
+
+        :param totals: The everef count of each date to claim, keyed YYYYMMDD
+        :param owner: Identifies the ingester, e.g. a run or job id
+        :param ttl: How long the claim holds if the ingester never returns
+        :param version: Dataset version the dates are ingested into, the live one if None
+        :returns: The dates claimed, in the order given; dates another ingester
+            holds or already committed with the same count are left out
+        """
+        dataset = Killmail._dataset_prefix(version)
+        now = datetime.now(timezone.utc)
+
+        def claim_dates(entries: dict, dates: list[str]) -> list[str]:
+            claimed = []
+            for date in dates:
+                entry = entries.setdefault(date, {})
+                if entry.get("source_count") == totals[date]:
+                    continue
+                if IngestLedger._is_claimed(entry, owner, now):
+                    continue
+                entry["claim"] = {
+                    "owner": owner,
+                    "expires_at": (now + ttl).isoformat(),
+                }
+                claimed.append(date)
+            return claimed
+
+        claimed = set()
+        for year, dates in IngestLedger._by_year(totals).items():
+            claimed.update(
+                IngestLedger._update(
+                    dataset, year, lambda entries: claim_dates(entries, dates)
+                )
+            )
+        return [date for date in totals if date in claimed]
+
+    @staticmethod
+    def commit(
+        date: str,
+        source_count: int,
+        written: dict,
+        content_hash: str,
+        version: int | None = None,
+    ) -> None:
+        """Records an ingested date, ending any claim on it.
+
+        :param date: The date, as YYYYMMDD
+        :param source_count: everef's killmail count for the archive that was read
+        :param written: What Killmail.upsert returned for the archive
+        :param content_hash: SHA-256 hex digest of the archive
+        :param version: Dataset version the date was ingested into, the live one if None
+        """
+        dataset = Killmail._dataset_prefix(version)
+
+        def commit_date(entries: dict) -> None:
+            entries[date] = {
+                "source_count": source_count,
+                "rows_written": written["rows_written"],
+                "files": written["files"],
+                "content_hash": content_hash,
+                "committed_at": datetime.now(timezone.utc).isoformat(),
+                "rollup_pending": True,
+            }
+
+        IngestLedger._update(dataset, date[:4], commit_date)
         return
 
     @staticmethod
-    def get_totals() -> dict:
+    def release(dates: list[str], owner: str, version: int | None = None) -> None:
+        """Gives up claims that were not committed, so the next run takes them.
+
+        :param dates: Dates claimed by the owner, as YYYYMMDD
+        :param owner: The ingester that claimed them
+        :param version: Dataset version the dates were claimed in, the live one if None
+        """
+        dataset = Killmail._dataset_prefix(version)
+
+        def release_dates(entries: dict, dates: list[str]) -> None:
+            for date in dates:
+                if entries.get(date, {}).get("claim", {}).get("owner") == owner:
+                    del entries[date]["claim"]
+                    if not entries[date]:  # never ingested
+                        del entries[date]
+
+        for year, dates in IngestLedger._by_year(dates).items():
+            IngestLedger._update(
+                dataset, year, lambda entries: release_dates(entries, dates)
+            )
+        return
+
+    @staticmethod
+    def claim_rollups(owner: str, version: int | None = None) -> dict[str, str]:
+        """Takes the rollup lease and lists the dates whose rollups are behind.
+
+        Rollup files are rewritten without conditions, the lease keeps a single
+        ingester rebuilding them at a time.
+
+        :param owner: Identifies the ingester, e.g. a run or job id
+        :param version: Dataset version to look at, the live one if None
+        :returns: The committed_at of each rollup_pending date, keyed YYYYMMDD;
+            empty if another ingester holds the lease
+        """
+        dataset = Killmail._dataset_prefix(version)
+        key = f"{INDEX_PREFIX}/{dataset}/rollup-lease.json"
+        now = datetime.now(timezone.utc)
+
+        lease, etag = IngestLedger._read(key)
+        if IngestLedger._is_claimed(lease, owner, now):
+            return {}
+
+        lease = {
+            "claim": {
+                "owner": owner,
+                "expires_at": (now + INGEST_CLAIM_TTL).isoformat(),
+            }
+        }
         try:
-            response = s3_client.get_object(
-                Bucket=DATALAKE_BUCKET,
-                Key="killmail-totals.json",
+            backend.put(
+                key,
+                json.dumps(lease).encode("utf-8"),
+                if_match=etag,
+                if_none_match=etag is None,
             )
-            content = response["Body"].read().decode("utf-8")
-            return json.loads(content)
-        except s3_client.exceptions.NoSuchKey:
+        except storage.ConditionFailed:  # taken by a concurrent ingester
             return {}
+
+        return {
+            date: entry["committed_at"]
+            for date, entry in IngestLedger.get(version).items()
+            if entry.get("rollup_pending")
+        }
+
+    @staticmethod
+    def release_rollups(
+        owner: str, rebuilt: dict[str, str], version: int | None = None
+    ) -> None:
+        """Clears the rollup_pending flag of rebuilt dates and gives up the lease.
+
+        :param owner: The ingester holding the lease
+        :param rebuilt: The dates whose rollups were rebuilt, as returned by
+            claim_rollups; empty when the rebuild failed
+        :param version: Dataset version the dates belong to, the live one if None
+        """
+        dataset = Killmail._dataset_prefix(version)
+
+        def clear_dates(entries: dict, dates: list[str]) -> None:
+            for date in dates:
+                # committed again since the rebuild read it, still behind
+                if entries.get(date, {}).get("committed_at") == rebuilt[date]:
+                    entries[date].pop("rollup_pending", None)
+
+        for year, dates in IngestLedger._by_year(rebuilt).items():
+            IngestLedger._update(
+                dataset, year, lambda entries: clear_dates(entries, dates)
+            )
+
+        key = f"{INDEX_PREFIX}/{dataset}/rollup-lease.json"
+        lease, _ = IngestLedger._read(key)
+        if lease.get("claim", {}).get("owner") == owner:
+            backend.delete(key)
+        return
+
+    # True when someone other than the owner holds an unexpired claim
+    @staticmethod
+    def _is_claimed(entry: dict, owner: str | None, now: datetime) -> bool:
+        claim = entry.get("claim")
+        return (
+            claim is not None
+            and claim["owner"] != owner
+            and datetime.fromisoformat(claim["expires_at"]) > now
+        )
+
+    @staticmethod
+    def _by_year(dates) -> dict[str, list[str]]:
+        years = {}
+        for date in dates:
+            years.setdefault(date[:4], []).append(date)
+        return years
+
+    @staticmethod
+    def _read(key: str) -> tuple[dict, str | None]:
+        if stored := backend.get(key):
+            content, etag = stored
+            return json.loads(content), etag
+        return {}, None
+
+    # optimistic, like the manifests: a writer that lost the race re-reads the
+    # year and applies its change again
+    @staticmethod
+    def _update(dataset: str, year: str, change):
+        key = f"{INDEX_PREFIX}/{dataset}/ledger/{year}.json"
+
+        while True:
+            entries, etag = IngestLedger._read(key)
+            result = change(entries)
+
+            try:
+                backend.put(
+                    key,
+                    json.dumps(entries, sort_keys=True).encode("utf-8"),
+                    if_match=etag,
+                    if_none_match=etag is None,
+                )
+                return result
+            except storage.ConditionFailed:
+                pass
+
+    # the totals ingested before the ledger existed become entries without
+    # the rows and files, which were never recorded
+    @staticmethod
+    def _seed(dataset: str) -> None:
+        stored = backend.get(TOTALS_KEY)
+        if stored is None:
+            return
+        totals = json.loads(stored[0])
+
+        for year, dates in IngestLedger._by_year(totals).items():
+            entries = {date: {"source_count": totals[date]} for date in dates}
+            try:
+                backend.put(
+                    f"{INDEX_PREFIX}/{dataset}/ledger/{year}.json",
+                    json.dumps(entries, sort_keys=True).encode("utf-8"),
+                    if_none_match=True,
+                )
+            except storage.ConditionFailed:  # seeded by a concurrent reader
+                pass
+        return
+
+
+class IngestJob:
+    """
+    Tracks a fanned-out killmail ingestion until every date has been committed.
+
+    Only one job is open at a time. Each worker marks its date as done and the
+    worker that completes the last date commits the job, exactly once.
+    """
+
+    @staticmethod
+    def create(job_id: str, dates: list[str]) -> None:
+        backend.put(
+            "ingest-jobs/current.json",
+            json.dumps(
+                {
+                    "job_id": job_id,
+                    "dates": dates,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                }
+            ).encode("utf-8"),
+        )
+        return
+
+    @staticmethod
+    def get_open() -> dict | None:
+        stored = backend.get("ingest-jobs/current.json")
+        if stored is None:
+            return None
+
+        job = json.loads(stored[0])
+        created_at = datetime.fromisoformat(job["created_at"])
+
+        if datetime.now(timezone.utc) - created_at > INGEST_JOB_TTL:
+            return None
+
+        return job
+
+    @staticmethod
+    def complete(job_id: str, date: str) -> dict | None:
+        """Marks a date of the job as committed.
+
+        :param job_id: The job the date belongs to
+        :param date: The committed date, as sent in the work item
+        :returns: The job if this call finished it, None otherwise
+        """
+        backend.put(f"ingest-jobs/{job_id}/done/{date}", b"")
+
+        job = IngestJob.get_open()
+        if job is None or job["job_id"] != job_id:
+            return None
+
+        done = {
+            key.rsplit("/", 1)[-1]
+            for key in backend.list(f"ingest-jobs/{job_id}/done/")
+        }
+
+        if not done.issuperset(job["dates"]):
+            return None
+
+        # several workers can see the last marker, only the first commit wins
+        try:
+            backend.put(f"ingest-jobs/{job_id}/committed", b"", if_none_match=True)
+        except storage.ConditionFailed:
+            return None
+
+        backend.delete("ingest-jobs/current.json")
+        return job
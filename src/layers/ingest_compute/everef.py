@@ -1,17 +1,61 @@
+import io
 import json
+import os
+import re
 import tarfile
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Iterator
 
-import fsspec
+import bz2blocks
 import polars as pl
 import requests
+import storage
+from polars.io.plugins import register_io_source
+
+# where downloads are kept for conditional GETs: "s3://bucket/prefix", a local
+# directory, or empty to always download in full
+CACHE_URL = os.environ.get("EVEREF_CACHE_URL", "")
+cache = storage.connect(CACHE_URL) if CACHE_URL else None
+
+# archives at least this large are decompressed block-parallel on this many
+# threads; off (1) by default, single-CPU measurements only showed it slower
+# (scripts/bench_bz2_decompression.py) and a 2048 MB Lambda gets ~1.2 vCPU
+PARALLEL_BZ2_MIN_SIZE = 16 * 1024 * 1024
+PARALLEL_BZ2_WORKERS = int(os.environ.get("PARALLEL_BZ2_WORKERS", "1"))
 
 BATCH_SIZE = 1_000
-CORP_ID = 98028546  # FORCA
+COLUMNAR_BATCH_SIZE = 10_000  # killmails per pl.read_json call
+
+# Every archive is decoded once for all tenants; rows are tagged with the tenant
+# whose corporations or alliances were involved, as attacker or victim.
+TRACKED_ENTITIES = {
+    "FORCA": {
+        "corporations": [98028546],  # FORCA
+        "alliances": [],
+    },
+}
+
+# Raw-byte prefilter: a killmail can only involve a tenant if one of the tracked
+# ids shows up as a standalone number somewhere in the document. A hit is not
+# proof (the same digits may belong to an item or another field), so hits still
+# go through the full parse; a miss is safe to skip without decoding any JSON.
+TRACKED_IDS_PATTERN = re.compile(
+    rb"(?<![0-9])(?:%b)(?![0-9])"
+    % b"|".join(
+        b"%d" % entity_id
+        for tenant in TRACKED_ENTITIES.values()
+        for entity_id in tenant["corporations"] + tenant["alliances"]
+    )
+)
+
+# bump whenever KILLMAIL_SCHEMA or the way rows are derived changes, then run
+# scripts/reprocess_killmails.py to rebuild the dataset for the new version
+KILLMAIL_SCHEMA_VERSION = 1
 
 KILLMAIL_SCHEMA = pl.Schema(
     {
+        "tenant": pl.String,
         "killmail_id": pl.UInt64,
         "date": pl.Date,
         "solar_system_id": pl.UInt32,
@@ -30,47 +74,490 @@ KILLMAIL_SCHEMA = pl.Schema(
     }
 )
 
+# "rows" unpacks every killmail in Python, "columnar" hands batches of raw
+# documents to Polars' JSON reader and explodes attackers as expressions
+DECODE_ENGINE = os.environ.get("KILLMAIL_DECODE_ENGINE", "rows")
+
+# only the fields _decode_columnar needs, everything else is skipped by the reader
+RAW_KILLMAIL_SCHEMA = pl.Schema(
+    {
+        "killmail_id": pl.UInt64,
+        "killmail_time": pl.String,
+        "solar_system_id": pl.UInt32,
+        "victim": pl.Struct(
+            {
+                "character_id": pl.UInt32,
+                "corporation_id": pl.UInt32,
+                "alliance_id": pl.UInt32,
+                "ship_type_id": pl.UInt32,
+            }
+        ),
+        "attackers": pl.List(
+            pl.Struct(
+                {
+                    "character_id": pl.UInt32,
+                    "corporation_id": pl.UInt32,
+                    "alliance_id": pl.UInt32,
+                    "ship_type_id": pl.UInt32,
+                    "weapon_type_id": pl.UInt32,
+                    "damage_done": pl.UInt64,
+                }
+            )
+        ),
+    }
+)
+
+_ITEM_FIELDS = {
+    "item_type_id": pl.UInt32,
+    "flag": pl.UInt32,
+    "quantity_destroyed": pl.UInt64,
+    "quantity_dropped": pl.UInt64,
+    "singleton": pl.UInt32,
+}
+
+# the whole killmail document, for the full-fidelity raw tables
+ARCHIVE_KILLMAIL_SCHEMA = pl.Schema(
+    {
+        "killmail_id": pl.UInt64,
+        "killmail_time": pl.String,
+        "solar_system_id": pl.UInt32,
+        "moon_id": pl.UInt32,
+        "war_id": pl.UInt32,
+        "victim": pl.Struct(
+            {
+                "character_id": pl.UInt32,
+                "corporation_id": pl.UInt32,
+                "alliance_id": pl.UInt32,
+                "faction_id": pl.UInt32,
+                "ship_type_id": pl.UInt32,
+                "damage_taken": pl.UInt64,
+                "position": pl.Struct(
+                    {"x": pl.Float64, "y": pl.Float64, "z": pl.Float64}
+                ),
+                "items": pl.List(
+                    pl.Struct(
+                        {**_ITEM_FIELDS, "items": pl.List(pl.Struct(_ITEM_FIELDS))}
+                    )
+                ),
+            }
+        ),
+        "attackers": pl.List(
+            pl.Struct(
+                {
+                    "character_id": pl.UInt32,
+                    "corporation_id": pl.UInt32,
+                    "alliance_id": pl.UInt32,
+                    "faction_id": pl.UInt32,
+                    "ship_type_id": pl.UInt32,
+                    "weapon_type_id": pl.UInt32,
+                    "damage_done": pl.UInt64,
+                    "final_blow": pl.Boolean,
+                    "security_status": pl.Float32,
+                }
+            )
+        ),
+    }
+)
+
+
+class HttpCache:
+    """
+    Persistent cache for everef downloads, revalidated with conditional GETs.
+
+    Bodies are stored under their URL path next to a `.meta.json` holding the
+    ETag and Last-Modified headers, so unchanged files cost a 304 instead of a
+    download and archives stay available for reprocessing.
+    """
+
+    @staticmethod
+    def get(url: str, revalidate: bool = True) -> bytes:
+        """Returns the body of `url`, from the cache when it is still current.
+
+        :param url: The URL to download
+        :param revalidate: When False, a cached body is returned without any request
+        :returns: The response body
+        """
+        if cache is None:
+            response = requests.get(url)
+            response.raise_for_status()
+            return response.content
+
+        key = url.split("://", 1)[-1]
+        raw_meta = HttpCache._read(f"{key}.meta.json")
+        meta = json.loads(raw_meta) if raw_meta else {}
+
+        if meta and not revalidate:
+            body = HttpCache._read(key)
+            if body is not None:
+                return body
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = requests.get(url, headers=headers)
+
+        if response.status_code == 304:
+            body = HttpCache._read(key)
+            if body is not None:
+                return body
+            response = requests.get(url)  # metadata without a body, start over
+
+        response.raise_for_status()
+
+        HttpCache._write(key, response.content)
+        HttpCache._write(
+            f"{key}.meta.json",
+            json.dumps(
+                {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+            ).encode("utf-8"),
+        )
+        return response.content
+
+    @staticmethod
+    def _read(key: str) -> bytes | None:
+        stored = cache.get(key)
+        return stored[0] if stored else None
+
+    @staticmethod
+    def _write(key: str, data: bytes) -> None:
+        cache.put(key, data)
+        return
+
 
 class Killmail:
     @staticmethod
     def fetch_totals() -> dict:
-        response = requests.get("https://data.everef.net/killmails/totals.json")
-        response.raise_for_status()
-        return response.json()
+        return json.loads(
+            HttpCache.get("https://data.everef.net/killmails/totals.json")
+        )
 
     @staticmethod
-    def fetch_killmails_from_date(date: datetime) -> pl.LazyFrame | None:
+    def download_killmails_archive(date: datetime, revalidate: bool = True) -> bytes:
         filename = f"https://data.everef.net/killmails/{date.year}/killmails-{date.year}-{date.month:02d}-{date.day:02d}.tar.bz2"
 
+        return HttpCache.get(filename, revalidate)
+
+    @staticmethod
+    def read_killmails(file, engine: str = DECODE_ENGINE) -> pl.LazyFrame:
+        """Decodes an everef tar.bz2 archive into KILLMAIL_SCHEMA rows.
+
+        Nothing is decoded up front: the archive is read batch by batch while the
+        frame is consumed, so sinking it holds about one batch in memory.
+
+        :param file: A seekable binary file object holding the archive
+        :param engine: "rows" or "columnar", see DECODE_ENGINE
+        :returns: The rows of every tracked tenant
+        """
+        decode = Killmail._decoder(engine)
+
+        def source(with_columns, predicate, n_rows, batch_size):
+            with Killmail._open_archive(file) as tar:
+                for df in decode(Killmail._iter_raw_killmails(tar)):
+                    if with_columns is not None:
+                        df = df.select(with_columns)
+                    if predicate is not None:
+                        df = df.filter(predicate)
+                    if n_rows is not None:
+                        df = df.head(n_rows)
+                        n_rows -= df.height
+
+                    yield df
+
+                    if n_rows == 0:
+                        return
+
+        return register_io_source(source, schema=KILLMAIL_SCHEMA)
+
+    @staticmethod
+    def read_killmails_with_raw(
+        file, engine: str = DECODE_ENGINE
+    ) -> tuple[pl.LazyFrame | None, dict[str, pl.DataFrame]]:
+        """Decodes an archive into KILLMAIL_SCHEMA rows and the raw tables, in one pass.
+
+        The raw tables keep every killmail of the archive, tracked or not, split
+        into "killmails", "attackers" and "items" keyed by killmail_id.
+
+        :param file: A binary file object positioned at the start of the archive
+        :param engine: "rows" or "columnar", see DECODE_ENGINE
+        :returns: The tenants' rows (or None) and the raw tables
+        """
+        decode = Killmail._decoder(engine)
+        raw_df_list = []
+
+        # raw tables see every document, the decoder only the prefiltered ones
+        def tracked_killmails(tar: tarfile.TarFile) -> Iterator[bytes]:
+            batch = []
+
+            for raw in Killmail._iter_raw_killmails(tar, prefilter=False):
+                batch.append(raw)
+                if len(batch) >= COLUMNAR_BATCH_SIZE:
+                    raw_df_list.append(Killmail._flatten_raw_killmails(batch))
+                    batch.clear()
+
+                if TRACKED_IDS_PATTERN.search(raw):
+                    yield raw
+
+            if batch:  # parse leftovers
+                raw_df_list.append(Killmail._flatten_raw_killmails(batch))
+
+        with Killmail._open_archive(file) as tar:
+            df_list = list(decode(tracked_killmails(tar)))
+
+        killmails = pl.concat(df_list).lazy() if df_list else None
+        raw_tables = {
+            name: pl.concat([tables[name] for tables in raw_df_list])
+            for name in ["killmails", "attackers", "items"]
+            if raw_df_list
+        }
+
+        return killmails, raw_tables
+
+    @staticmethod
+    def unpack_killmails(killmails: list[dict]) -> pl.DataFrame:
+        """Flattens already parsed killmail documents, such as live feed entries.
+
+        :param killmails: ESI killmail documents
+        :returns: The rows of every tracked tenant, possibly empty
+        """
+        return pl.DataFrame(
+            [
+                row
+                for killmail in killmails
+                for row in Killmail._unpack_killmail(killmail)
+            ],
+            schema=KILLMAIL_SCHEMA,
+        )
+
+    @staticmethod
+    @contextmanager
+    def _open_archive(file) -> Iterator[tarfile.TarFile]:
+        file.seek(0)
+        data = file.getvalue() if isinstance(file, io.BytesIO) else file.read()
+
+        if len(data) < PARALLEL_BZ2_MIN_SIZE or PARALLEL_BZ2_WORKERS < 2:
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:bz2") as tar:
+                yield tar
+            return
+
+        # members are read in order, so the tar can be consumed as a stream
+        with bz2blocks.ParallelBz2Reader(data, PARALLEL_BZ2_WORKERS) as reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                yield tar
+
+    @staticmethod
+    def _decoder(engine: str):
+        decoders = {
+            "rows": Killmail._decode_rows,
+            "columnar": Killmail._decode_columnar,
+        }
+        if engine not in decoders:
+            raise ValueError(f"Unknown decode engine: {engine}")
+
+        return decoders[engine]
+
+    @staticmethod
+    def _iter_raw_killmails(
+        tar: tarfile.TarFile, prefilter: bool = True
+    ) -> Iterator[bytes]:
+        for member in tar:
+            file = tar.extractfile(member)
+            if not file:
+                continue
+
+            raw = file.read()
+            if prefilter and not TRACKED_IDS_PATTERN.search(raw):
+                continue
+
+            yield raw
+
+    @staticmethod
+    def _decode_rows(raw_killmails: Iterator[bytes]) -> Iterator[pl.DataFrame]:
         batch_data = []
-        df_list = []
 
-        with fsspec.open(filename, "rb") as file:
-            with tarfile.open(fileobj=file, mode="r:bz2") as tar:
-                for member in tar:
-                    file = tar.extractfile(member)
-                    if not file:
-                        continue
+        for raw in raw_killmails:
+            batch_data.extend(Killmail._unpack_killmail(json.loads(raw)))
+
+            if len(batch_data) >= BATCH_SIZE:
+                yield pl.DataFrame(batch_data, schema=KILLMAIL_SCHEMA)
+                batch_data.clear()
+
+        if batch_data:  # parse leftovers
+            yield pl.DataFrame(batch_data, schema=KILLMAIL_SCHEMA)
+
+    @staticmethod
+    def _decode_columnar(raw_killmails: Iterator[bytes]) -> Iterator[pl.DataFrame]:
+        batch = []
+
+        for raw in raw_killmails:
+            batch.append(raw)
+
+            if len(batch) >= COLUMNAR_BATCH_SIZE:
+                yield Killmail._flatten_killmails(batch)
+                batch.clear()
+
+        if batch:  # parse leftovers
+            yield Killmail._flatten_killmails(batch)
 
-                    file_data = json.loads(file.read())
-                    batch_data.extend(Killmail._unpack_killmail(file_data))
+    # vectorized equivalent of _unpack_killmail over a batch of raw documents
+    @staticmethod
+    def _flatten_killmails(raw_killmails: list[bytes]) -> pl.DataFrame:
+        killmails = pl.read_json(
+            b"[" + b",".join(raw_killmails) + b"]", schema=RAW_KILLMAIL_SCHEMA
+        )
+
+        victim = pl.col("victim").struct
+        attacker = pl.col("attackers").struct
+
+        attacker_rows = (
+            killmails.lazy()
+            .with_columns(
+                total_attackers_count=pl.col("attackers")
+                .list.eval(pl.element().struct.field("character_id").is_not_null())
+                .list.sum(),
+            )
+            .explode("attackers")
+            .filter(attacker.field("character_id").is_not_null())
+        )
+
+        def is_member(entity: pl.Expr, tenant: dict) -> pl.Expr:
+            return entity.struct.field("corporation_id").is_in(
+                tenant["corporations"]
+            ) | entity.struct.field("alliance_id").is_in(tenant["alliances"])
+
+        tenant_rows = [
+            attacker_rows.with_columns(
+                tenant=pl.lit(name),
+                is_loss=is_member(pl.col("victim"), tenant).fill_null(False),
+            ).filter(is_member(pl.col("attackers"), tenant) | pl.col("is_loss"))
+            for name, tenant in TRACKED_ENTITIES.items()
+        ]
+
+        return (
+            pl.concat(tenant_rows)
+            .select(
+                pl.col("tenant"),
+                pl.col("killmail_id"),
+                pl.col("killmail_time")
+                .str.to_datetime("%Y-%m-%dT%H:%M:%SZ")
+                .dt.date()
+                .alias("date"),
+                pl.col("solar_system_id"),
+                victim.field("character_id").alias("victim_character_id"),
+                victim.field("corporation_id").alias("victim_corporation_id"),
+                victim.field("alliance_id").alias("victim_alliance_id"),
+                victim.field("ship_type_id").alias("victim_ship_type_id"),
+                attacker.field("character_id").alias("attacker_character_id"),
+                attacker.field("corporation_id").alias("attacker_corporation_id"),
+                attacker.field("alliance_id").alias("attacker_alliance_id"),
+                attacker.field("ship_type_id").alias("attacker_ship_type_id"),
+                attacker.field("weapon_type_id").alias("attacker_weapon_type_id"),
+                attacker.field("damage_done").alias("attacker_damage_done"),
+                pl.col("total_attackers_count"),
+                pl.col("is_loss"),
+            )
+            .cast(KILLMAIL_SCHEMA)
+            .collect()
+        )
 
-                    if len(batch_data) >= BATCH_SIZE:
-                        df_list.append(pl.DataFrame(batch_data, schema=KILLMAIL_SCHEMA))
-                        batch_data.clear()
+    @staticmethod
+    def _flatten_raw_killmails(raw_killmails: list[bytes]) -> dict[str, pl.DataFrame]:
+        killmails = (
+            pl.read_json(
+                b"[" + b",".join(raw_killmails) + b"]", schema=ARCHIVE_KILLMAIL_SCHEMA
+            )
+            .with_columns(
+                pl.col("killmail_time").str.to_datetime(
+                    "%Y-%m-%dT%H:%M:%SZ", time_zone="UTC"
+                )
+            )
+            .with_columns(date=pl.col("killmail_time").dt.date())
+        )
+
+        victims = killmails.select(
+            "killmail_id",
+            "date",
+            "killmail_time",
+            "solar_system_id",
+            "moon_id",
+            "war_id",
+            pl.col("victim").struct.field("character_id").alias("victim_character_id"),
+            pl.col("victim")
+            .struct.field("corporation_id")
+            .alias("victim_corporation_id"),
+            pl.col("victim").struct.field("alliance_id").alias("victim_alliance_id"),
+            pl.col("victim").struct.field("faction_id").alias("victim_faction_id"),
+            pl.col("victim").struct.field("ship_type_id").alias("victim_ship_type_id"),
+            pl.col("victim").struct.field("damage_taken").alias("victim_damage_taken"),
+            pl.col("victim").struct.field("position").struct.field("x").alias("x"),
+            pl.col("victim").struct.field("position").struct.field("y").alias("y"),
+            pl.col("victim").struct.field("position").struct.field("z").alias("z"),
+            pl.col("attackers").list.len().cast(pl.UInt16).alias("attackers_count"),
+        )
 
-                if batch_data:  # parse leftovers
-                    df_list.append(pl.DataFrame(batch_data, schema=KILLMAIL_SCHEMA))
+        attackers = (
+            killmails.select(
+                "killmail_id",
+                "date",
+                pl.col("attackers")
+                .list.eval(pl.int_range(pl.len(), dtype=pl.UInt16))
+                .alias("attacker_index"),
+                "attackers",
+            )
+            .explode("attacker_index", "attackers")
+            .drop_nulls("attacker_index")
+            .unnest("attackers")
+        )
 
-        if df_list:
-            return pl.concat(df_list).lazy()
+        # top-level items, then the contents of containers pointing at their parent
+        items = (
+            killmails.select(
+                "killmail_id",
+                "date",
+                pl.col("victim").struct.field("items").alias("item"),
+            )
+            .with_columns(
+                item_index=pl.col("item").list.eval(
+                    pl.int_range(pl.len(), dtype=pl.UInt32)
+                )
+            )
+            .explode("item", "item_index")
+            .drop_nulls("item_index")
+            .unnest("item")
+        )
+        contents = (
+            items.select(
+                "killmail_id",
+                "date",
+                pl.col("item_index").alias("container_index"),
+                pl.col("items").alias("item"),
+            )
+            .explode("item")
+            .drop_nulls("item")
+            .unnest("item")
+        )
+        items = pl.concat(
+            [
+                items.drop("items").with_columns(
+                    container_index=pl.lit(None, dtype=pl.UInt32)
+                ),
+                contents.with_columns(item_index=pl.lit(None, dtype=pl.UInt32)),
+            ],
+            how="diagonal",
+        ).select("killmail_id", "date", "item_index", "container_index", *_ITEM_FIELDS)
 
-        return None
+        return {"killmails": victims, "attackers": attackers, "items": items}
 
     # generator to stream killmail data into flat structure
     @staticmethod
     def _unpack_killmail(killmail_data) -> Iterator[dict]:
         attackers = killmail_data["attackers"]
+        victim = killmail_data["victim"]
 
         base = {
             "killmail_id": killmail_data["killmail_id"],
@@ -78,27 +565,37 @@ class Killmail:
                 killmail_data["killmail_time"], "%Y-%m-%dT%H:%M:%SZ"
             ).date(),
             "solar_system_id": killmail_data["solar_system_id"],
-            "victim_character_id": killmail_data["victim"].get("character_id"),
-            "victim_corporation_id": killmail_data["victim"].get("corporation_id"),
-            "victim_alliance_id": killmail_data["victim"].get("alliance_id"),
-            "victim_ship_type_id": killmail_data["victim"].get("ship_type_id"),
+            "victim_character_id": victim.get("character_id"),
+            "victim_corporation_id": victim.get("corporation_id"),
+            "victim_alliance_id": victim.get("alliance_id"),
+            "victim_ship_type_id": victim.get("ship_type_id"),
             "total_attackers_count": len(
                 [attacker for attacker in attackers if attacker.get("character_id")]
             ),
-            "is_loss": int(killmail_data["victim"].get("corporation_id")) == CORP_ID,
         }
 
-        for attacker in attackers:
-            if attacker.get("character_id") and (
-                int(attacker.get("corporation_id")) == CORP_ID
-                or int(killmail_data["victim"].get("corporation_id")) == CORP_ID
-            ):
-                yield {
-                    **base,
-                    "attacker_character_id": attacker["character_id"],
-                    "attacker_corporation_id": attacker.get("corporation_id"),
-                    "attacker_alliance_id": attacker.get("alliance_id"),
-                    "attacker_ship_type_id": attacker.get("ship_type_id"),
-                    "attacker_weapon_type_id": attacker.get("weapon_type_id"),
-                    "attacker_damage_done": attacker.get("damage_done"),
-                }
+        for name, tenant in TRACKED_ENTITIES.items():
+            is_loss = Killmail._is_member(victim, tenant)
+
+            for attacker in attackers:
+                if attacker.get("character_id") and (
+                    is_loss or Killmail._is_member(attacker, tenant)
+                ):
+                    yield {
+                        **base,
+                        "tenant": name,
+                        "is_loss": is_loss,
+                        "attacker_character_id": attacker["character_id"],
+                        "attacker_corporation_id": attacker.get("corporation_id"),
+                        "attacker_alliance_id": attacker.get("alliance_id"),
+                        "attacker_ship_type_id": attacker.get("ship_type_id"),
+                        "attacker_weapon_type_id": attacker.get("weapon_type_id"),
+                        "attacker_damage_done": attacker.get("damage_done"),
+                    }
+
+    @staticmethod
+    def _is_member(entity: dict, tenant: dict) -> bool:
+        return (
+            entity.get("corporation_id") in tenant["corporations"]
+            or entity.get("alliance_id") in tenant["alliances"]
+        )
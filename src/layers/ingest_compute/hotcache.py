@@ -0,0 +1,125 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import polars as pl
+
+# warm Lambda containers keep /tmp between invocations; POLARS_TEMP_DIR is
+# where polars itself spills, so the cache lives next to it
+HOT_CACHE_DIR = os.path.join(
+    os.environ.get("POLARS_TEMP_DIR", tempfile.gettempdir()), "datalake-hot-cache"
+)
+HOT_CACHE_MAX_MB = int(os.environ.get("HOT_CACHE_MAX_MB", "256"))  # 0 disables it
+# larger files are always scanned from the datalake, a single one would evict
+# most of the cache
+HOT_CACHE_FILE_MAX_MB = int(os.environ.get("HOT_CACHE_FILE_MAX_MB", "64"))
+
+
+class HotCache:
+    """
+    Read-through cache of datalake files, stored as uncompressed Arrow IPC so
+    that scans memory-map them instead of downloading and decoding Parquet.
+
+    Entries are named after the S3 key and ETag of their source, so a file that
+    changed is never served stale. The least recently read entries are evicted
+    to stay within HOT_CACHE_MAX_MB.
+
+    A miss streams the file into its entry and maps that, so the file is
+    downloaded once; files that are not cached are scanned as Parquet, with
+    projection and predicate pushdown.
+    """
+
+    @staticmethod
+    def scan(url: str, etag: str | None, size: int | None = None) -> pl.LazyFrame:
+        """Scans a Parquet file through the cache.
+
+        :param url: The s3:// URL or local path of the file
+        :param etag: The ETag of the current version of the file, if known
+        :param size: The in-memory size of the file's rows, in bytes, if known;
+            files of unknown size or above HOT_CACHE_FILE_MAX_MB are not cached
+        :returns: The file's rows, memory-mapped from the cache when possible
+        """
+        killmails = pl.scan_parquet(url, hive_partitioning=False)
+        if not HOT_CACHE_MAX_MB or etag is None:
+            return killmails
+
+        entry = HotCache._entry_path(url, etag)
+        # mapped now rather than at collect, so a later eviction cannot pull
+        # the file from under the query; columns not read are never paged in
+        if os.path.exists(entry):
+            try:
+                os.utime(entry)  # recently used, evicted last
+                return pl.read_ipc(entry, memory_map=True).lazy()
+            except FileNotFoundError:  # evicted by a concurrent reader
+                pass
+
+        if size is None or size > HOT_CACHE_FILE_MAX_MB * 1024 * 1024:
+            return killmails
+
+        os.makedirs(HOT_CACHE_DIR, exist_ok=True)
+        HotCache._remove_versions(url)
+
+        # streamed batch by batch, never held in memory as a whole; written
+        # aside under a name of its own, then renamed, so a reader never maps
+        # a partial file and concurrent writers never share one
+        partial = f"{entry}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            killmails.sink_ipc(partial, compression="uncompressed")
+            os.replace(partial, entry)
+        except FileNotFoundError:  # the cache directory was cleared meanwhile
+            HotCache._remove(partial)
+            return killmails
+
+        HotCache._evict()
+
+        # read from the new entry like a hit, the data file is fetched once
+        try:
+            return pl.read_ipc(entry, memory_map=True).lazy()
+        except FileNotFoundError:  # evicted by a concurrent reader
+            return killmails
+
+    @staticmethod
+    def _entry_path(url: str, etag: str) -> str:
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        version = etag.strip('"')
+        return os.path.join(HOT_CACHE_DIR, f"{name}-{version}.arrow")
+
+    # only finished entries: partial files belong to the writers filling them.
+    # Entries can vanish under any of these calls, removed by a concurrent
+    # reader, which is what was wanted anyway.
+    @staticmethod
+    def _remove_versions(url: str) -> None:
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        for entry in os.listdir(HOT_CACHE_DIR):
+            if entry.startswith(f"{name}-") and entry.endswith(".arrow"):
+                HotCache._remove(os.path.join(HOT_CACHE_DIR, entry))
+        return
+
+    # mapped entries stay readable after removal, their space is freed once unmapped
+    @staticmethod
+    def _evict() -> None:
+        entries = []
+        for entry in os.scandir(HOT_CACHE_DIR):
+            if entry.name.endswith(".arrow"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used <= HOT_CACHE_MAX_MB * 1024 * 1024:
+                break
+            HotCache._remove(path)
+            used -= size
+        return
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
@@ -0,0 +1,147 @@
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+QUEUE_SIZE = 2  # items waiting between two stages
+MEMORY_LIMIT_MB = int(os.environ.get("INGEST_MEMORY_LIMIT_MB", "1024"))
+
+_DONE = object()
+
+
+class MemoryBudget:
+    """
+    Bounds the bytes held by items in flight between pipeline stages.
+
+    A reservation larger than the whole budget is still granted once nothing
+    else is held, so a single oversized item slows the pipeline down instead of
+    deadlocking it.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int, cancel: threading.Event) -> bool:
+        with self._condition:
+            while self.in_use and self.in_use + size > self.limit:
+                if cancel.is_set():
+                    return False
+                self._condition.wait(timeout=0.1)
+            self.in_use += size
+        return True
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.in_use -= size
+            self._condition.notify_all()
+        return
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages, one thread per stage, connected by
+    bounded queues so downloads, decoding and uploads of different items overlap.
+
+    The first stage's output is charged against the memory budget using
+    `reserve`, and released once the item leaves the last stage.
+    """
+
+    def __init__(
+        self,
+        stages: list[Callable[[Any], Any]],
+        reserve: Callable[[Any], int] = len,
+        memory_limit: int = MEMORY_LIMIT_MB * 1024 * 1024,
+        queue_size: int = QUEUE_SIZE,
+    ):
+        self.stages = stages
+        self.reserve = reserve
+        self.budget = MemoryBudget(memory_limit)
+        self.queue_size = queue_size
+
+    def run(self, items: Iterable) -> Iterator[tuple[Any, Any]]:
+        """Feeds items through every stage.
+
+        :param items: The inputs of the first stage
+        :returns: (item, last stage output) pairs, in input order
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        results = queue.Queue()
+        stop = threading.Event()
+        errors = []
+
+        def put(q: queue.Queue, value) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(value, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _DONE
+
+        def fail(exc: Exception):
+            errors.append(exc)
+            stop.set()
+            results.put(_DONE)
+
+        def source():
+            try:
+                for item in items:
+                    if not put(queues[0], (item, None, 0)):
+                        return
+            except Exception as exc:
+                fail(exc)
+                return
+            put(queues[0], _DONE)
+
+        def worker(index: int, stage: Callable):
+            is_last = index == len(self.stages) - 1
+            while (work := get(queues[index])) is not _DONE:
+                item, value, reserved = work
+                try:
+                    value = stage(item if index == 0 else value)
+                    if index == 0:
+                        reserved = self.reserve(value)
+                        if not self.budget.acquire(reserved, cancel=stop):
+                            return
+                except Exception as exc:
+                    fail(exc)
+                    return
+
+                if is_last:
+                    self.budget.release(reserved)
+                    results.put((item, value))
+                elif not put(queues[index + 1], (item, value, reserved)):
+                    return
+
+            if is_last:
+                results.put(_DONE)
+            else:
+                put(queues[index + 1], _DONE)
+
+        threads = [threading.Thread(target=source, daemon=True)] + [
+            threading.Thread(target=worker, args=(index, stage), daemon=True)
+            for index, stage in enumerate(self.stages)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while (result := results.get()) is not _DONE:
+                yield result
+        finally:
+            stop.set()
+
+        if errors:
+            raise errors[0]
+
+        return
@@ -0,0 +1,252 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+class ConditionFailed(Exception):
+    """A conditional put lost against another writer."""
+
+
+class S3Storage:
+    """
+    Objects in an S3 bucket, under an optional key prefix. ETags and
+    conditional puts are S3's own.
+    """
+
+    # error codes of a conditional write that lost against another writer
+    CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.client = boto3.client("s3")
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+
+    def url(self, key: str) -> str:
+        """Where polars reads and writes an object.
+
+        :param key: The object key
+        :returns: Its s3:// URL
+        """
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        """Reads an object.
+
+        :param key: The object key
+        :returns: Its content and ETag, None if it does not exist
+        """
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{key}"
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read(), response["ETag"]
+
+    def head(self, key: str) -> str | None:
+        """Reads the ETag of an object.
+
+        :param key: The object key
+        :returns: Its ETag, None if it does not exist
+        """
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{key}"
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return response["ETag"]
+
+    def put(
+        self,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: bool = False,
+    ) -> str:
+        """Writes an object, optionally only if it is unchanged or absent.
+
+        :param key: The object key
+        :param body: The content
+        :param if_match: Only write if the object still has this ETag
+        :param if_none_match: Only write if the object does not exist
+        :returns: The ETag of the written object
+        :raises ConditionFailed: If the condition did not hold
+        """
+        condition = {}
+        if if_match is not None:
+            condition["IfMatch"] = if_match
+        if if_none_match:
+            condition["IfNoneMatch"] = "*"
+
+        try:
+            response = self.client.put_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{key}", Body=body, **condition
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in S3Storage.CONFLICT_CODES:
+                raise ConditionFailed(key) from exc
+            raise
+        return response["ETag"]
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+        return
+
+    def list(self, prefix: str) -> list[str]:
+        """Lists the keys starting with a prefix.
+
+        :param prefix: The key prefix
+        :returns: The keys, in lexicographic order
+        """
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=f"{self.prefix}{prefix}"
+        ):
+            keys.extend(
+                item["Key"].removeprefix(self.prefix)
+                for item in page.get("Contents", [])
+            )
+        return keys
+
+
+class LocalStorage:
+    """
+    Objects as files under a directory, so the datalake can run without AWS.
+
+    ETags are derived from each file's inode, modification time and size.
+    Writes go to a temporary file that is renamed into place, under a lock on
+    the directory, so conditional puts hold across threads and processes.
+    """
+
+    LOCK_FILE = ".lock"
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    # parent directories are created, polars does not create them when writing
+    def url(self, key: str) -> str:
+        """Where polars reads and writes an object.
+
+        :param key: The object key
+        :returns: Its path under the root directory
+        """
+        path = os.path.join(self.root, *key.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path if not key.endswith("/") else f"{path}/"
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        """Reads an object.
+
+        :param key: The object key
+        :returns: Its content and ETag, None if it does not exist
+        """
+        path = os.path.join(self.root, *key.split("/"))
+        with self._lock(fcntl.LOCK_SH):
+            if not os.path.isfile(path):
+                return None
+            with open(path, "rb") as file:
+                return file.read(), LocalStorage._etag(path)
+
+    def head(self, key: str) -> str | None:
+        """Reads the ETag of an object.
+
+        :param key: The object key
+        :returns: Its ETag, None if it does not exist
+        """
+        path = os.path.join(self.root, *key.split("/"))
+        if not os.path.isfile(path):
+            return None
+        return LocalStorage._etag(path)
+
+    def put(
+        self,
+        key: str,
+        body: bytes,
+        if_match: str | None = None,
+        if_none_match: bool = False,
+    ) -> str:
+        """Writes an object, optionally only if it is unchanged or absent.
+
+        :param key: The object key
+        :param body: The content
+        :param if_match: Only write if the object still has this ETag
+        :param if_none_match: Only write if the object does not exist
+        :returns: The ETag of the written object
+        :raises ConditionFailed: If the condition did not hold
+        """
+        path = self.url(key)
+        with self._lock(fcntl.LOCK_EX):
+            current = self.head(key)
+            if (if_none_match and current is not None) or (
+                if_match is not None and current != if_match
+            ):
+                raise ConditionFailed(key)
+
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+            with open(partial, "wb") as file:
+                file.write(body)
+            os.replace(partial, path)
+            return LocalStorage._etag(path)
+
+    def delete(self, key: str) -> None:
+        path = os.path.join(self.root, *key.split("/"))
+        with self._lock(fcntl.LOCK_EX):
+            if os.path.isfile(path):
+                os.remove(path)
+        return
+
+    def list(self, prefix: str) -> list[str]:
+        """Lists the keys starting with a prefix.
+
+        :param prefix: The key prefix
+        :returns: The keys, in lexicographic order
+        """
+        # only the directory holding the prefix has to be walked
+        directory = os.path.join(self.root, *prefix.split("/")[:-1])
+        keys = []
+        for parent, _, files in os.walk(directory):
+            for name in files:
+                key = os.path.relpath(os.path.join(parent, name), self.root)
+                key = key.replace(os.sep, "/")
+                if (
+                    key.startswith(prefix)
+                    and key != LocalStorage.LOCK_FILE
+                    and not name.endswith(".partial")
+                ):
+                    keys.append(key)
+        return sorted(keys)
+
+    @contextmanager
+    def _lock(self, operation: int):
+        # opened anew each time: flock locks belong to the open file, so this
+        # excludes other threads as well as other processes
+        with open(os.path.join(self.root, LocalStorage.LOCK_FILE), "a") as file:
+            fcntl.flock(file, operation)
+            yield
+
+    @staticmethod
+    def _etag(path: str) -> str:
+        stat = os.stat(path)
+        return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def connect(url: str):
+    """Opens the storage backend a URL points at.
+
+    :param url: "s3://bucket/prefix" (the prefix is optional), or a local directory
+    :returns: An S3Storage or LocalStorage
+    """
+    if url.startswith("s3://"):
+        bucket, _, prefix = url.removeprefix("s3://").partition("/")
+        return S3Storage(bucket, prefix)
+
+    return LocalStorage(url)
@@ -0,0 +1,66 @@
+import os
+
+import polars as pl
+
+# named Parquet settings for the datalake files; scripts/bench_write_profiles.py
+# compares their size, write time and query time on real archives
+WRITE_PROFILES = {
+    # daily files are rewritten on every ingest of their date, write speed first
+    "ingest-fast": {
+        "sort": [],
+        "compression": "lz4",
+        "statistics": True,
+    },
+    # polars' defaults
+    "balanced": {
+        "sort": [],
+        "compression": "zstd",
+        "statistics": True,
+    },
+    # closed months are written once and read many times: sorted so the row
+    # group statistics let date and character filters skip most of the file
+    "archive-compact": {
+        "sort": ["date", "attacker_character_id"],
+        "compression": "zstd",
+        "compression_level": 12,
+        "row_group_size": 16_384,
+        "statistics": "full",
+    },
+}
+
+INGEST_WRITE_PROFILE = os.environ.get("INGEST_WRITE_PROFILE", "balanced")
+COMPACTION_WRITE_PROFILE = os.environ.get("COMPACTION_WRITE_PROFILE", "archive-compact")
+
+
+def prepare(
+    killmails: pl.DataFrame | pl.LazyFrame, profile: str
+) -> pl.DataFrame | pl.LazyFrame:
+    """Puts rows in the order a profile writes them in.
+
+    :param killmails: The rows to write
+    :param profile: A WRITE_PROFILES name
+    :returns: The rows, sorted by the profile's sort keys
+    """
+    sort = WRITE_PROFILES[profile]["sort"]
+    return killmails.sort(sort) if sort else killmails
+
+
+def write(killmails: pl.DataFrame | pl.LazyFrame, target, profile: str) -> None:
+    """Writes rows with a profile's codec, row group size and statistics.
+
+    :param killmails: The rows to write, already ordered by prepare; lazy
+        rows are streamed to the target instead of being collected first
+    :param target: A path, s3:// URL or file object
+    :param profile: A WRITE_PROFILES name
+    """
+    options = {
+        option: value
+        for option, value in WRITE_PROFILES[profile].items()
+        if option != "sort"
+    }
+    if isinstance(killmails, pl.LazyFrame):
+        killmails.sink_parquet(target, **options)
+        return
+
+    killmails.write_parquet(target, **options)
+    return
@@ -0,0 +1,35 @@
+import os
+
+import requests
+
+# point REDISQ_URL at scripts/redisq_standin.py to replay a local archive
+REDISQ_URL = os.environ.get("REDISQ_URL", "https://zkillredisq.stream/listen.php")
+REDISQ_QUEUE_ID = os.environ.get("REDISQ_QUEUE_ID", "forcinha-bot")
+
+
+class RedisQ:
+    @staticmethod
+    def listen(time_to_wait: int = 10) -> dict | None:
+        """Waits for the next killmail on the RedisQ feed.
+
+        :param time_to_wait: Seconds the feed may hold the request open when idle
+        :returns: The ESI killmail document, or None if nothing arrived in time
+        """
+        response = requests.get(
+            REDISQ_URL,
+            params={"queueID": REDISQ_QUEUE_ID, "ttw": time_to_wait},
+            timeout=time_to_wait + 10,
+        )
+        response.raise_for_status()
+
+        package = response.json().get("package")
+        if not package:
+            return None
+
+        if "killmail" in package:
+            return package["killmail"]
+
+        # the feed may only reference the killmail, fetch it from ESI
+        response = requests.get(package["zkb"]["href"])
+        response.raise_for_status()
+        return response.json()